@@ -0,0 +1,341 @@
+import asyncio
+import time
+
+from framing import FramingError, split_frame
+from outbound import FLUSH_THRESHOLD
+from server import Server, LISTEN_BACKLOG, CONSUMER_CHECK, HANDSHAKE_TIMEOUT, HANDSHAKE_MAX_BYTES
+from log import log
+
+# asyncio engine for the TinyIRC server.
+# Connections are driven by the platform's best selector (epoll on Linux)
+# instead of select.select, so the server is not capped at FD_SETSIZE and
+# idle connections cost nothing per loop iteration. The event loop accepts
+# up to LISTEN_BACKLOG waiting connections per wakeup of the listening socket.
+
+
+class ClientProtocol(asyncio.Protocol):
+    """
+    One instance per client connection.
+
+    The protocol object stands in for the client socket everywhere the Server
+    expects one (Server.clients keys, just_send, close_client), so every
+    existing $$ command handler works unchanged.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        # Until the username frame has arrived, after which the
+        # negotiated codec's decoder takes over
+        self.buffer = bytearray()
+        self.decoder = None
+        self.paused = False
+        self.throttled = False
+        self.deferred = []
+        self.pending = []
+        self.pending_size = 0
+        self.handshake_timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.server.high_watermark, low=self.server.low_watermark)
+        peer = transport.get_extra_info('peername')
+        self.server.metrics.accepts += 1
+        log.info("Accepted new connection from %s:%s", peer[0], peer[1])
+        self.handshake_timer = asyncio.get_running_loop().call_later(HANDSHAKE_TIMEOUT, self.handshake_expired)
+
+    def handshake_expired(self):
+        if self not in self.server.clients and not self.transport.is_closing():
+            log.info("Dropping connection that sent no username within %ds", HANDSHAKE_TIMEOUT)
+            self.server.metrics.handshake_timeouts += 1
+            self.server.close_client(self)
+
+    def data_received(self, data):
+        """
+        Handle every frame completed by this read, one message per frame.
+        """
+        self.server.metrics.bytes_in += len(data)
+        if self.decoder is None:
+            data = self.handshake(data)
+            if not data:
+                return
+        try:
+            messages = self.decoder.feed(data)
+        except FramingError as e:
+            log.warning("Dropping connection: %s", e)
+            self.server.close_client(self)
+            return
+        self.handle_messages(messages)
+
+    def handshake(self, data):
+        """
+        Buffer data until the username frame is complete, like
+        Server.continue_handshake. Returns the bytes received after it,
+        which are for the decoder of the negotiated codec.
+        """
+        self.buffer += data
+        try:
+            split = split_frame(self.buffer, HANDSHAKE_MAX_BYTES)
+        except FramingError as e:
+            log.warning("Dropping connection: %s", e)
+            self.server.close_client(self)
+            return None
+        if split is None:
+            if len(self.buffer) > HANDSHAKE_MAX_BYTES:
+                self.server.close_client(self)
+            return None
+        message, rest = split
+        self.buffer = None
+        if not self.server.finish_handshake(self, message):
+            self.close()
+            return None
+        return rest
+
+    def handle_messages(self, messages):
+        """
+        Messages left over once the client is paused wait for resume_writing,
+        or for unthrottle if the client went over its rate limits.
+        """
+        for i, message in enumerate(messages):
+            if self.paused or self.throttled:
+                self.deferred = messages[i:]
+                return
+            wait = self.server.rate_wait(self, message)
+            if wait:
+                self.throttle(wait)
+                self.deferred = messages[i:]
+                return
+            self.server.handle_message(self, message)
+
+    def connection_lost(self, exc):
+        self.handshake_timer.cancel()
+        self.server.handle_lost(self)
+
+    # Backpressure: stop reading from a client while its output backs up
+    def pause_writing(self):
+        self.paused = True
+        self.transport.pause_reading()
+        self.server.start_lagging(self)
+
+    def resume_writing(self):
+        self.paused = False
+        self.server.caught_up(self)
+        deferred, self.deferred = self.deferred, []
+        self.handle_messages(deferred)
+        if not self.paused and not self.throttled:
+            self.transport.resume_reading()
+
+    # Rate limiting: stop reading from a client until it has tokens again
+    def throttle(self, wait):
+        self.throttled = True
+        self.transport.pause_reading()
+        asyncio.get_running_loop().call_later(wait, self.unthrottle)
+
+    def unthrottle(self):
+        if self.transport.is_closing():
+            return
+        self.throttled = False
+        deferred, self.deferred = self.deferred, []
+        self.handle_messages(deferred)
+        if not self.paused and not self.throttled:
+            self.transport.resume_reading()
+
+    # Socket stand-ins used by the Server
+    def send(self, data):
+        """
+        Frames are collected and handed to the transport in one write at
+        the end of the event loop iteration, or once FLUSH_THRESHOLD is reached.
+        data may be a frame in pieces, see OutboundQueue.
+        """
+        first = not self.pending
+        if type(data) is tuple:
+            self.pending.extend(data)
+            size = sum(map(len, data))
+        else:
+            self.pending.append(data)
+            size = len(data)
+        self.pending_size += size
+        self.server.write_stats.frames += 1
+        if self.pending_size >= FLUSH_THRESHOLD:
+            self.flush()
+        elif first:
+            self.server.schedule_flush(self)
+        return size
+
+    def flush(self):
+        """
+        Room changes the frames may acknowledge are committed first,
+        this can be before the end of the iteration.
+        """
+        if not self.pending or self.transport.is_closing():
+            return
+        self.server.store.commit()
+        self.server.write_stats.writes += 1
+        self.server.write_stats.bytes += self.pending_size
+        self.transport.writelines(self.pending)
+        self.pending = []
+        self.pending_size = 0
+
+    def shutdown(self, how):
+        self.close()
+
+    def close(self):
+        self.flush()
+        self.transport.close()
+
+
+class ScrapeProtocol(asyncio.Protocol):
+    """
+    Connection to the metrics endpoint, answered once the request arrives.
+    """
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.transport.write(self.server.metrics.http_response(self.server.write_stats, self.server.queue_depths()))
+        self.transport.close()
+
+
+class AsyncServer(Server):
+    """
+    TinyIRC server running on an asyncio event loop.
+
+    Shares all room state and command handling with Server, only the
+    connection management differs. The listening socket created by
+    Server.__init__ is handed to the event loop.
+    """
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.dirty = set()
+        self.tick_started = 0
+        self.tick_scheduled = False
+
+    def finish_handshake(self, protocol, message):
+        """
+        Set up the session of a connection from its username frame.
+        Returns False if the connection is refused.
+        """
+        user = self.handshake(protocol, message)
+        if user is False:
+            return False
+        protocol.handshake_timer.cancel()
+        self.clients[protocol] = user
+        protocol.decoder = self.codecs[protocol].decoder()
+        self.registry.connect(user.uid, protocol)
+        log.info("Accepted new user: %s", user.name)
+        return True
+
+    def handle_message(self, protocol, message):
+        """
+        Every frame after the username is a lobby command.
+        """
+        user = self.clients[protocol]
+        log.debug("Received message from %s: %r", user.name, message.get('data') or message.get('command'))
+        self.run_command(protocol, message)
+
+    def handle_lost(self, protocol):
+        """
+        Peer went away or the transport was closed by us.
+        """
+        self.codecs.pop(protocol, None)
+        self.consumers.stop(protocol)
+        self.presence.forget(protocol)
+        user = self.clients.pop(protocol, None)
+        if user is not None:
+            self.registry.disconnect(user.uid, protocol)
+            log.info("Closed connection from %s", user.name)
+
+    def queue_send(self, client_socket, data):
+        """
+        The transport buffers outgoing data itself and applies the watermarks.
+        """
+        client_socket.send(data)
+
+    def flush_client(self, client_socket):
+        client_socket.flush()
+
+    def schedule_flush(self, protocol):
+        """
+        Flush the protocol's frames once the current batch of I/O callbacks
+        has run, which is the end of this event loop iteration.
+        """
+        self.schedule_tick()
+        self.dirty.add(protocol)
+
+    def schedule_tick(self):
+        """
+        Iterations without output, like a disconnect seen by watchers of a
+        room, need ending too.
+        """
+        if not self.tick_scheduled:
+            asyncio.get_running_loop().call_soon(self.end_tick)
+            self.tick_started = time.perf_counter()
+            self.tick_scheduled = True
+
+    def end_tick(self):
+        """
+        Iterations are timed from the first callback that produced output
+        to the flush that ends them.
+        """
+        super().end_tick()
+        self.tick_scheduled = False
+        self.metrics.loop.observe(time.perf_counter() - self.tick_started)
+
+    def flush_output(self):
+        dirty, self.dirty = self.dirty, set()
+        for protocol in dirty:
+            protocol.flush()
+
+    def backlog(self, protocol):
+        return protocol.transport.get_write_buffer_size() + protocol.pending_size
+
+    def start_lagging(self, protocol):
+        """
+        Nothing else wakes the loop up for a client that stays backed up
+        without being sent anything, so check on lagging clients periodically.
+        """
+        if not self.consumers.lagging:
+            asyncio.get_running_loop().call_later(CONSUMER_CHECK, self.watch_consumers)
+        self.consumers.start(protocol)
+
+    def watch_consumers(self):
+        self.check_consumers()
+        if self.consumers.lagging:
+            asyncio.get_running_loop().call_later(CONSUMER_CHECK, self.watch_consumers)
+
+    def evict(self, protocol):
+        """
+        Closing a transport waits for its unsent data, which a slow
+        consumer would never take, so evicted ones are aborted.
+        """
+        super().evict(protocol)
+        protocol.transport.abort()
+
+    def close_client(self, client_socket):
+        self.codecs.pop(client_socket, None)
+        self.consumers.stop(client_socket)
+        self.presence.forget(client_socket)
+        user = self.clients.pop(client_socket, None)
+        if user is not None:
+            self.registry.disconnect(user.uid, client_socket)
+        client_socket.close()
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: ClientProtocol(self),
+                                          sock=self.server_listen_socket,
+                                          backlog=LISTEN_BACKLOG)
+        if self.metrics_socket is not None:
+            await loop.create_unix_server(lambda: ScrapeProtocol(self), sock=self.metrics_socket)
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        """
+        Forever:
+                Let the event loop accept and serve connections
+        """
+        log.info("Central server now listening (asyncio)...")
+        asyncio.run(self.serve())
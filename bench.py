@@ -0,0 +1,376 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from framing import FrameDecoder, FramingError, encode_frame
+
+# Headless load generator for the TinyIRC server.
+#
+# Opens many simulated clients in one process, all speaking the original
+# 10 byte header protocol, runs a scripted scenario and prints one JSON
+# object with throughput and latency figures, e.g.
+#
+#     python bench.py huge_room --clients 2000 --messages 20
+#
+# Every message sent carries the sender's clock in its body, so delivery
+# latency is measured end to end on the receiving client. Command latency is
+# measured from sending a command to its (first) reply.
+
+IP = "127.0.0.1"
+CONNECTION_PORT = 9001
+
+SCENARIOS = ('join_storm', 'small_rooms', 'huge_room', 'list_flood', 'slow_readers')
+
+# Connections opened at once while building up the client population
+CONNECT_CONCURRENCY = 200
+
+# Reply to the $$whoami that marks the end of a listing
+WHOAMI_REPLY = b'You are currently user'
+
+
+def client_name(i):
+    """
+    Usernames must be alphabetical.
+    """
+    return 'bench' + ''.join(chr(ord('a') + int(d)) for d in str(i))
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class BenchClient(asyncio.Protocol):
+    """
+    One simulated client. Replies to commands resolve the futures returned by
+    request(), in order; room messages are timed and counted by the Bench.
+
+    Listings can take several frames, request_listing() follows the command
+    with a $$whoami and takes everything up to its reply as the answer.
+    """
+    def __init__(self, bench, name):
+        self.bench = bench
+        self.name = name
+        self.transport = None
+        self.decoder = FrameDecoder()
+        self.replies = []
+        self.received = 0
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.write(encode_frame(self.name.encode('utf-8')))
+
+    def data_received(self, data):
+        try:
+            messages = self.decoder.feed(data)
+        except FramingError as e:
+            self.bench.errors += 1
+            print(f"{self.name}: {e}", file=sys.stderr)
+            self.transport.close()
+            return
+        now = time.perf_counter()
+        for message in messages:
+            data = message['data']
+            if data.startswith(b'['):
+                self.received += 1
+                self.bench.delivered(data, now)
+            elif self.replies:
+                future, sent, frames = self.replies[0]
+                if frames is not None and not data.startswith(WHOAMI_REPLY):
+                    frames.append(data.decode('utf-8'))
+                    continue
+                self.replies.pop(0)
+                self.bench.command_latencies.append(now - sent)
+                future.set_result(data.decode('utf-8') if frames is None else frames)
+
+    def connection_lost(self, exc):
+        for future, _, _ in self.replies:
+            if not future.done():
+                future.set_exception(ConnectionError(f"{self.name} lost its connection"))
+        self.replies = []
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+    def send(self, command):
+        self.transport.write(encode_frame(command.encode('utf-8')))
+
+    def request(self, command):
+        """
+        Send a command that is answered with one reply frame.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.replies.append((future, time.perf_counter(), None))
+        self.send(command)
+        return future
+
+    def request_listing(self, command):
+        """
+        Send a command answered with any number of frames, the future
+        gets the list of them.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.replies.append((future, time.perf_counter(), []))
+        self.send(command)
+        self.send("$$whoami")
+        return future
+
+    def say(self, room, padding=''):
+        """
+        Send a timed message to a room.
+        """
+        self.send(f"$$send {room} t={time.perf_counter():.9f} {padding}")
+
+    def close(self):
+        self.transport.close()
+
+
+class Bench:
+    """
+    A population of clients against one server plus the measurements
+    taken while a scenario runs.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.clients = []
+        self.latencies = []
+        self.command_latencies = []
+        self.deliveries = 0
+        self.errors = 0
+        self.expected = 0
+        self.done = None
+
+    def delivered(self, data, now):
+        """
+        Room messages look like '[room] user: t=<sent> ...'.
+        """
+        self.deliveries += 1
+        marker = data.find(b': t=')
+        if marker != -1:
+            end = data.find(b' ', marker + 4)
+            self.latencies.append(now - float(data[marker + 4:end if end != -1 else None]))
+        if self.expected and self.deliveries >= self.expected and not self.done.done():
+            self.done.set_result(None)
+
+    async def connect(self, count, first=0):
+        """
+        Open count more clients, a bounded number at a time.
+        """
+        loop = asyncio.get_running_loop()
+        gate = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+        async def one(i):
+            async with gate:
+                _, client = await loop.create_connection(lambda: BenchClient(self, client_name(i)),
+                                                         self.args.host, self.args.port)
+                return client
+
+        clients = await asyncio.gather(*(one(i) for i in range(first, first + count)))
+        self.clients.extend(clients)
+        # The server reads the username before anything else, give it a moment
+        # to register everyone so no command races the handshake
+        await asyncio.sleep(0.05 + count / 20000)
+        return clients
+
+    async def requests(self, pairs):
+        """
+        Send (client, command) pairs and wait for every reply.
+        """
+        return await asyncio.gather(*(client.request(command) for client, command in pairs))
+
+    def expect(self, deliveries):
+        self.deliveries = 0
+        self.latencies = []
+        self.expected = deliveries
+        self.done = asyncio.get_running_loop().create_future()
+
+    async def wait_deliveries(self):
+        try:
+            await asyncio.wait_for(asyncio.shield(self.done), self.args.timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+    def report(self, scenario, elapsed, count, unit, latencies, **extra):
+        latencies = sorted(latencies)
+        result = {'scenario': scenario,
+                  'clients': len(self.clients),
+                  'elapsed_s': round(elapsed, 6),
+                  unit: count,
+                  f'{unit}_per_sec': round(count / elapsed, 1) if elapsed else None,
+                  'latency_ms': {'p50': self.ms(percentile(latencies, 0.50)),
+                                 'p99': self.ms(percentile(latencies, 0.99)),
+                                 'max': self.ms(latencies[-1] if latencies else None),
+                                 'samples': len(latencies)},
+                  'errors': self.errors}
+        result.update(extra)
+        return result
+
+    @staticmethod
+    def ms(seconds):
+        return None if seconds is None else round(seconds * 1000, 3)
+
+
+async def setup_rooms(bench, rooms):
+    """
+    Create (room name, members) pairs, the first member creating the room
+    and the rest joining it.
+    """
+    await bench.requests((members[0], f"$$create {name}") for name, members in rooms)
+    await bench.requests((client, f"$$join {name}") for name, members in rooms for client in members[1:])
+
+
+async def run_messages(bench, scenario, room_list, talkers, readers, **extra):
+    """
+    Every sender says args.messages things in its room, then wait until
+    every reader in those rooms has received them all.
+    """
+    messages = bench.args.messages
+    padding = 'x' * bench.args.size
+    listening = {name: sum(1 for client in members if client in readers) for name, members in room_list}
+    expected = 0
+    for name, client in talkers:
+        expected += messages * (listening[name] - (client in readers))
+    bench.expect(expected)
+    started = time.perf_counter()
+    for _ in range(messages):
+        for name, client in talkers:
+            client.say(name, padding)
+        # Let the loop write and read between rounds
+        await asyncio.sleep(0)
+    await bench.wait_deliveries()
+    elapsed = time.perf_counter() - started
+    return bench.report(scenario, elapsed, bench.deliveries, 'messages', bench.latencies,
+                        expected=expected, sent=messages * len(talkers), **extra)
+
+
+async def join_storm(bench):
+    """
+    Everyone connects and joins one room at once.
+    """
+    started = time.perf_counter()
+    clients = await bench.connect(bench.args.clients)
+    connected = time.perf_counter()
+    await bench.requests([(clients[0], "$$create storm")])
+    bench.command_latencies = []
+    joined_at = time.perf_counter()
+    await bench.requests((client, "$$join storm") for client in clients[1:])
+    elapsed = time.perf_counter() - joined_at
+    return bench.report('join_storm', elapsed, len(clients) - 1, 'joins', bench.command_latencies,
+                        connect_s=round(connected - started, 6))
+
+
+async def small_rooms(bench):
+    """
+    Many rooms of args.room_size members, every member talks.
+    """
+    clients = await bench.connect(bench.args.clients)
+    size = bench.args.room_size
+    rooms = [(f"small{client_name(i)[5:]}", clients[i:i + size]) for i in range(0, len(clients), size)]
+    await setup_rooms(bench, rooms)
+    senders = [(name, client) for name, members in rooms for client in members]
+    return await run_messages(bench, 'small_rooms', rooms, senders, set(clients),
+                              rooms=len(rooms), room_size=size)
+
+
+async def huge_room(bench):
+    """
+    Everyone in one room, args.senders of them talk.
+    """
+    clients = await bench.connect(bench.args.clients)
+    rooms = [("huge", clients)]
+    await setup_rooms(bench, rooms)
+    senders = [("huge", client) for client in clients[:bench.args.senders]]
+    return await run_messages(bench, 'huge_room', rooms, senders, set(clients),
+                              senders=len(senders))
+
+
+async def list_flood(bench):
+    """
+    args.rooms rooms exist and every client keeps asking for $$list all.
+    """
+    clients = await bench.connect(bench.args.clients)
+    owner = clients[0]
+    await bench.requests((owner, f"$$create list{client_name(i)[5:]}") for i in range(bench.args.rooms))
+    bench.command_latencies = []
+    started = time.perf_counter()
+    for _ in range(bench.args.messages):
+        await asyncio.gather(*(client.request_listing("$$list all") for client in clients))
+    elapsed = time.perf_counter() - started
+    return bench.report('list_flood', elapsed, len(bench.command_latencies), 'replies',
+                        bench.command_latencies, rooms=bench.args.rooms)
+
+
+async def slow_readers(bench):
+    """
+    One big room where a fraction of the members stop reading.
+    Throughput and latency are measured on the members still reading.
+    """
+    clients = await bench.connect(bench.args.clients)
+    rooms = [("slow", clients)]
+    await setup_rooms(bench, rooms)
+    slow = clients[len(clients) - int(len(clients) * bench.args.slow_fraction):]
+    for client in slow:
+        client.transport.pause_reading()
+    readers = set(clients) - set(slow)
+    senders = [("slow", client) for client in clients[:bench.args.senders]]
+    return await run_messages(bench, 'slow_readers', rooms, senders, readers,
+                              senders=len(senders), slow_readers=len(slow))
+
+
+async def run(args):
+    bench = Bench(args)
+    try:
+        return await globals()[args.scenario](bench)
+    finally:
+        bench.close()
+
+
+def raise_fd_limit():
+    """
+    Thousands of clients need thousands of descriptors.
+    """
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="TinyIRC load generator")
+    parser.add_argument('scenario', choices=SCENARIOS)
+    parser.add_argument('--host', default=IP)
+    parser.add_argument('--port', type=int, default=CONNECTION_PORT)
+    parser.add_argument('--clients', type=int, default=1000, help="simulated clients")
+    parser.add_argument('--messages', type=int, default=10,
+                        help="messages per sender, or $$list rounds for list_flood")
+    parser.add_argument('--size', type=int, default=32, help="padding bytes per message")
+    parser.add_argument('--room-size', type=int, default=10, help="members per room for small_rooms")
+    parser.add_argument('--senders', type=int, default=10, help="talking members for huge_room and slow_readers")
+    parser.add_argument('--rooms', type=int, default=500, help="rooms to list for list_flood")
+    parser.add_argument('--slow-fraction', type=float, default=0.1,
+                        help="share of members that stop reading for slow_readers")
+    parser.add_argument('--timeout', type=float, default=30, help="seconds to wait for deliveries")
+    parser.add_argument('--output', help="append the JSON result to this file instead of printing it")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    raise_fd_limit()
+    result = asyncio.run(run(args))
+    line = json.dumps(result)
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(line + '\n')
+    else:
+        print(line)
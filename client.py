@@ -1,36 +1,32 @@
-import socket
-import select
-import errno
-import re
+import asyncio
 import os
 import signal
 import sys
+import threading
 import pprint
-import time
 from helper import check_for_config, lobby_welcome, end_session, interpret_lobby_message
-
-HEADER_LENGTH = 10
-
-IP = "127.0.0.1"
-CONNECTION_PORT = 9001
+from tinyclient import TinyClient, Presence, IP, CONNECTION_PORT
+from presence import describe
 
 class Client:
     """
     TinyIRC client
-    Establishes a TCP connection with server at specified IP and
-    port 9001. Then sends messages and commands to the server after
-    connection has been established.
+    Interactive front end over the TinyClient library, which holds the
+    TCP connection with the server at specified IP and port 9001.
+    Lines typed by the user are validated, sent as commands and their
+    replies printed as soon as the server has answered. Room messages are
+    printed the moment they arrive, whether or not the user is typing.
     """
     def __init__(self):
         self.pp = pprint.PrettyPrinter(indent=4)
 
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.connect((IP, CONNECTION_PORT))
-        self.client_socket.setblocking(False)
+        self.connection = None
+        self.loop = None
         self.username = ''
         self.entered = False
         self.entered_channel = ''
-        self.ticker = 0
+        self.prompting = False
+        self.ending = False
         self.config = {'username':'','rooms':[]}
 
 
@@ -39,52 +35,38 @@ class Client:
         else:
             print("No config file detected... Please setup your name.")
             while not self.username.isalpha() or len(self.username) > 30:
-                self.username = input("Please enter alphabetical username of 30 characters or less: ").encode('utf-8')
-            self.config['username'] = self.username.decode('utf-8')
+                self.username = input("Please enter alphabetical username of 30 characters or less: ")
+            self.config['username'] = self.username
     
 
     # Handle ctrl+C crash
     def signal_handler(self, sig, frame):
-        print('You pressed Ctrl+C! Config will not be saved!')
-        sys.exit(0)
-
-    def send_message(self, message):
-        """
-        Basic send message mechanism. Allows client to send
-        a fixed 10 utf-8 byte header that contains the length of the
-        following payload message.
-        """
-        message = message.encode('utf-8')
-        header = f"{len(message):<{HEADER_LENGTH}}".encode('utf-8')
-        self.client_socket.send(header + message)
+        print('\nYou pressed Ctrl+C! Config will not be saved!')
+        self.quit(0)
 
-
-    def receive_message(self):
+    def quit(self, status):
         """
-        Receive a message from a server socket
-        First interprets the header of 10 bytes,
-        which is telling the server the length of the following message
+        Exit while the input thread may be blocked reading stdin, which
+        a normal interpreter shutdown can't cope with.
         """
-        try:
-            message_header = self.client_socket.recv(HEADER_LENGTH)
-
-            if not len(message_header):
-                return False
-
-            message_length = int(message_header.decode("utf-8").strip())
-            return {"header": message_header, "data":self.client_socket.recv(message_length)}
-
-        except:
-            return False
+        sys.stdout.flush()
+        os._exit(status)
 
-    def get_input(self):
-        prompt = f"{self.username.decode('utf-8')} > "
+    def prompt(self):
+        prompt = f"{self.username} > "
         if self.entered:
             prompt += self.entered_channel + ' : '
-        return input(prompt)
+        return prompt
 
+    def get_input(self):
+        self.prompting = True
+        try:
+            return input(self.prompt())
+        finally:
+            self.prompting = False
 
-    def handle_message_to_send(self, message):
+
+    async def handle_message_to_send(self, message):
         """
         Interpret a client message and send to server, if validated.
 
@@ -93,7 +75,8 @@ class Client:
         """
         if message == "$$$end":
             end_session(self)
-            self.client_socket.close()
+            self.ending = True
+            await self.connection.close()
             sys.exit(0)
 
         client_analysis = interpret_lobby_message(self, message)
@@ -102,7 +85,7 @@ class Client:
             print(f"Exiting active mode in channel {self.entered_channel}")
             self.entered = False
             self.entered_channel = ''
-            self.send_message(message)
+            await self.show_replies(self.connection.exit())
         elif (self.entered and message) or client_analysis:
             split_message = message.split()
             if self.entered and split_message[0:1] is not ['$$send', str(self.entered_channel)]:
@@ -115,72 +98,93 @@ class Client:
                 self.entered_channel = _room
                 print(f"Attempting to enter room {_room}")
 
-            self.send_message(message)
-            # Sleep slightly to allow IO
-            time.sleep(0.1)
+            await self.show_replies(self.connection.command_line(message))
 
 
-    def check_socket(self):
+    async def show_replies(self, replies):
+        """
+        Print the server's replies to a command once they are all in.
+        Check if one indicates the client has 'exited' a room.
         """
-        Client checks it's private socket with server for a message.
-        Make sure it's not a Boot message. Check if it's a message
-        indicating client has 'exited' a room.
+        for recvd in await replies:
+            print(recvd)
+            if recvd.split()[-1:] == ["NONACTIVE"]:
+                self.entered = False
+                self.entered_channel = ''
+
+
+    async def display(self):
+        """
+        Print room messages as they arrive. The prompt is redrawn below
+        them if the user was at it.
+
+        The server closing the connection, whether it booted us or crashed,
+        ends the session right away.
+        """
+        async for message in self.connection:
+            if isinstance(message, Presence):
+                text = f"[{message.room}] * {describe(message.changes)}"
+            elif message.room is None:
+                text = message.body
+            else:
+                text = f"[{message.room}] {message.user}: {message.body}"
+            print(f"\r{text}")
+            if self.prompting:
+                print(self.prompt(), end='', flush=True)
+        if self.ending:
+            return
+        print("\nError! Server connection lost... Config will not be saved!")
+        self.quit(1)
+
+
+    async def handle_line(self, message):
+        try:
+            if message:
+                await self.handle_message_to_send(message)
+        except ConnectionError as e:
+            print('Reading error', str(e))
+            end_session(self)
+            sys.exit(0)
+
+
+    def read_input(self):
+        """
+        Runs in its own thread, so waiting for the user never blocks the
+        connection. Each line is handled on the event loop before the
+        next prompt is shown.
         """
         while True:
-            msg = self.receive_message()
-            
-            # Booted
-            if msg and msg['data'].decode('utf-8').split()[0] == "Booting":
-                print("Error! Server connection lost... Booted")
-                end_session(self)
-                self.client_socket.close()
-                sys.exit(0)
-            if msg:
-                recvd = msg['data'].decode('utf-8')
-                print(recvd)
-                if recvd.split()[-1] == "NONACTIVE":
-                    self.entered = False
-                    self.entered_channel = ''
-            if not msg:
-                # I believe this is what's broken and causing
-                # 'client gracefully handles server crash' to fail.
-                # Problems with my ticker strategy to imitate immediate I/O though.
-                # Probably need a functional GUI to handle this best.
-                break
-
-
-    def run(self):
+            try:
+                message = self.get_input()
+            except EOFError:
+                message = "$$$end"
+            future = asyncio.run_coroutine_threadsafe(self.handle_line(message), self.loop)
+            try:
+                future.result()
+            except BaseException:
+                # The session ended, the exit is raised on the event loop
+                return
+
+
+    async def run(self):
         """
         Main routine, message processing
-        Establish a connection with server by sending username.
+        Establish a connection with server by sending username,
+        asking for large replies to be compressed.
 
-        Then forever:
-                Get client input
-                Handle the input (or lack thereof)
-                Check for a response
-                Catch errors
+        Then, until the session ends:
+                Handle lines from the input thread
+                Display room messages as the server sends them
         """
-        self.send_message(self.username.decode('utf-8'))
+        self.loop = asyncio.get_running_loop()
+        self.connection = TinyClient(self.username, IP, CONNECTION_PORT)
+        await self.connection.connect()
         lobby_welcome()
-        while True:
-            message = self.get_input()
-            if message:
-                self.handle_message_to_send(message)
-                
-            try:
-                self.check_socket()
-                        
-            except IOError as e:
-                if e.errno != errno.EAGAIN and e.errno != errno.EWOULDBLOCK:
-                    print('Reading error', str(e))
-                    end_session(self)
-                continue
-
-            except Exception as e:
-                print('General error', str(e))
-                end_session(self)
-
-
-c = Client()
-signal.signal(signal.SIGINT, c.signal_handler)
-c.run()
+        threading.Thread(target=self.read_input, daemon=True).start()
+        await self.display()
+
+
+if __name__ == "__main__":
+    c = Client()
+    signal.signal(signal.SIGINT, c.signal_handler)
+    asyncio.run(c.run())
@@ -0,0 +1,515 @@
+import itertools
+import json
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import sys
+import tempfile
+import zlib
+
+from framing import FrameDecoder, FramingError, RECV_CHUNK, encode_frame
+from commands import COMMANDS, Command, CommandError
+from outbound import OutboundQueue, SlowConsumers, HIGH_WATERMARK, LOW_WATERMARK, DROP, EVICT
+from server import Server, Session
+from log import log, setup_logging, stop_logging
+
+# Multi-process TinyIRC server.
+#
+# N worker processes all bind the listening port with SO_REUSEPORT, so the
+# kernel spreads client connections across them. The parent process runs a
+# message bus on a Unix socket that the workers talk to each other through.
+#
+# Every room is owned by one worker, picked by hashing its name. Commands
+# that change or read a single room are forwarded to the owner and executed
+# there, so each room has a single, ordered history. The owner replicates the
+# resulting room changes to every worker, which keeps a full read replica of
+# the room directory for $$list, and relays $$send traffic only to the
+# workers holding connected members.
+#
+# A client's commands still run one at a time, in the order it sent them:
+# while one is out at another worker the client's next commands wait, as
+# they do for a paused client, until the owner reports it done. So replies
+# come back in order, and a command sees the changes of the ones before it.
+#
+# Worker 0 alone writes the rooms to disk. A change is acknowledged by the
+# worker owning the room as soon as it is made, a moment before worker 0
+# has logged it, so a crash can lose the last changes acknowledged.
+#
+# Bus frames use the normal 10 byte header framing. The payload is the
+# destination (a worker id, '*' for every other worker, or 'hub') followed by
+# a space and a JSON object.
+#
+# A worker that doesn't keep up with its bus traffic is handled like a slow
+# consumer, see SlowConsumers: room messages for it are dropped once it lags
+# too long or too far, and past the eviction limits it is cut off the bus.
+# The other workers are told, disconnect its users and give up on commands
+# waiting for it. A worker cut off the bus exits.
+
+ROOM_COMMANDS = {"$$create", "$$delete", "$$join", "$$leave", "$$send", "$$enter", "$$history"}
+
+
+def shard_of(roomname, workers):
+    """
+    Worker owning a room. Stable across processes, unlike hash().
+    """
+    return zlib.crc32(roomname.encode('utf-8')) % workers
+
+
+# Payloads of relayed room messages start with this, see WorkerServer.broadcast,
+# which lets the bus drop them for a lagging worker without decoding them
+DELIVER_PREFIX = b'{"op": "deliver"'
+
+
+def bus_frame(to, msg):
+    return encode_frame(f"{to} ".encode('utf-8') + json.dumps(msg).encode('utf-8'))
+
+
+class Bus:
+    """
+    Message hub run by the parent process.
+
+    Routes frames between workers by their destination prefix without
+    decoding the JSON. Output for a worker is queued from the start, so
+    nothing is lost if a worker connects to the bus late. Once a worker has
+    left, nothing is queued for it any more.
+    """
+    def __init__(self, path, workers):
+        self.path = path
+        self.listen_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listen_socket.bind(path)
+        self.listen_socket.listen(workers)
+        self.workers = workers
+        self.conns = [self.listen_socket]
+        self.sockets = {}
+        self.worker_of = {}
+        self.decoders = {}
+        self.outbound = {worker: OutboundQueue() for worker in range(workers)}
+        self.lagging = SlowConsumers()
+        self.gone = set()
+
+    def route(self, sender, payload):
+        to, _, body = payload.partition(b' ')
+        if to == b'hub':
+            hello = json.loads(body)
+            worker = hello['worker']
+            self.sockets[worker] = sender
+            self.worker_of[sender] = worker
+            log.info("Worker %s joined the bus", worker)
+            return
+        frame = encode_frame(payload)
+        droppable = body.startswith(DELIVER_PREFIX)
+        if to == b'*':
+            targets = [w for w in range(self.workers) if w != self.worker_of.get(sender)]
+        else:
+            targets = [int(to)]
+        for worker in targets:
+            self.queue(worker, frame, droppable)
+
+    def queue(self, worker, frame, droppable=False):
+        """
+        Queue a frame for a worker, unless it is a room message for a
+        lagging worker. A worker past the eviction limits is cut off.
+        """
+        if worker in self.gone:
+            return
+        queue = self.outbound[worker]
+        lagging = self.lagging
+        if worker in lagging.lagging:
+            if droppable:
+                verdict = lagging.verdict(worker, len(queue))
+            else:
+                verdict = EVICT if lagging.evicting(worker, len(queue)) else None
+            if verdict == DROP:
+                return
+            if verdict == EVICT:
+                log.error("Cutting worker %d off the bus: %d bytes unsent, lagging for %.1fs",
+                          worker, len(queue), lagging.lag(worker))
+                self.leave(worker)
+                return
+        queue.append(frame)
+        if len(queue) > HIGH_WATERMARK and worker not in lagging.lagging:
+            log.warning("Outbound backlog of %d bytes for worker %d", len(queue), worker)
+            lagging.start(worker)
+
+    def leave(self, worker):
+        """
+        A worker left the bus or was cut off. Its output is thrown away and
+        the other workers are told it is gone.
+        """
+        self.gone.add(worker)
+        self.outbound[worker] = OutboundQueue()
+        self.lagging.stop(worker)
+        sock = self.sockets.pop(worker, None)
+        if sock is not None:
+            self.close(sock)
+        for other in range(self.workers):
+            if other != worker:
+                self.queue(other, bus_frame(other, {'op': 'gone', 'worker': worker, 'from': 'hub'}))
+
+    def close(self, sock):
+        self.conns.remove(sock)
+        self.decoders.pop(sock, None)
+        self.worker_of.pop(sock, None)
+        sock.close()
+
+    def run(self):
+        log.info("Cluster bus listening on %s", self.path)
+        while True:
+            writers = [self.sockets[w] for w, queue in self.outbound.items() if len(queue) and w in self.sockets]
+            readable, writable, _ = select.select(self.conns, writers, [])
+            for sock in readable:
+                if sock is self.listen_socket:
+                    conn, _ = sock.accept()
+                    conn.setblocking(False)
+                    self.conns.append(conn)
+                    self.decoders[conn] = FrameDecoder()
+                    continue
+                if sock not in self.decoders:
+                    # Cut off while handling an earlier socket
+                    continue
+                try:
+                    data = sock.recv(RECV_CHUNK)
+                    messages = self.decoders[sock].feed(data) if data else None
+                except (OSError, FramingError) as e:
+                    log.warning("Bus read error %s", e)
+                    messages = None
+                if messages is None:
+                    worker = self.worker_of.get(sock)
+                    log.info("Worker %s left the bus", worker)
+                    if worker is not None:
+                        self.leave(worker)
+                    else:
+                        self.close(sock)
+                    continue
+                for message in messages:
+                    self.route(sock, message['data'])
+            for sock in writable:
+                worker = self.worker_of.get(sock)
+                if worker is None:
+                    continue
+                queue = self.outbound[worker]
+                try:
+                    queue.drain(sock)
+                except OSError as e:
+                    log.warning("Bus write error %s", e)
+                    self.leave(worker)
+                    continue
+                if worker in self.lagging.lagging and len(queue) <= LOW_WATERMARK:
+                    dropped = self.lagging.stop(worker)
+                    log.info("Worker %d caught up, %d room messages were dropped", worker, dropped)
+
+
+class RemoteClient:
+    """
+    Stands in for the socket of a client connected to another worker.
+
+    Listed in Server.clients and the registry like a local connection, so
+    the command handlers run unchanged for users of other workers. Replies
+    and broadcasts addressed to it are forwarded over the bus.
+    """
+    def __init__(self, worker, conn):
+        self.worker = worker
+        self.conn = conn
+
+    def __repr__(self):
+        return f"RemoteClient(worker={self.worker}, conn={self.conn})"
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+
+class WorkerServer(Server):
+    """
+    One worker of a clustered server. Serves its own share of client
+    connections with the select engine and cooperates with the other
+    workers over the bus.
+    """
+    reuse_port = True
+
+    def __init__(self, worker_id, workers, bus_path, *args):
+        self.worker_id = worker_id
+        self.workers = workers
+        # Every worker holds a full replica, worker 0 alone writes it to disk
+        self.persist = worker_id == 0
+        super().__init__(*args)
+        self.conn_counter = itertools.count()
+        self.conn_ids = {}
+        self.conns = {}
+        self.remotes = {}
+        # Local connection -> worker its command is out at
+        self.forwarded = {}
+        # Workers cut off the bus
+        self.gone = set()
+
+        self.bus_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.bus_socket.connect(bus_path)
+        self.bus_socket.setblocking(False)
+        self.sockets_list.append(self.bus_socket)
+        self.decoders[self.bus_socket] = FrameDecoder()
+        self.outbound[self.bus_socket] = OutboundQueue()
+        self.bus_send('hub', {'worker': worker_id})
+        self.registry.listeners.append(self.replicate)
+
+    def history_path(self):
+        """
+        Each worker keeps the history of the rooms it owns.
+        """
+        return os.path.join(self.store.path, f'history-{self.worker_id}')
+
+    def bus_send(self, to, msg):
+        msg['from'] = self.worker_id
+        self.outbound[self.bus_socket].append(bus_frame(to, msg))
+        if self.bus_socket not in self.blocked_writes:
+            self.pending_writes.add(self.bus_socket)
+
+    def owns(self, roomname):
+        return shard_of(roomname, self.workers) == self.worker_id
+
+    # Connections
+    def finish_handshake(self, client_socket, message):
+        if not super().finish_handshake(client_socket, message):
+            return False
+        conn = next(self.conn_counter)
+        self.conn_ids[client_socket] = conn
+        self.conns[conn] = client_socket
+        user = self.clients[client_socket].name
+        self.bus_send('*', {'op': 'connect', 'conn': conn, 'user': user})
+        return True
+
+    def close_client(self, client_socket):
+        conn = self.conn_ids.pop(client_socket, None)
+        if conn is not None:
+            del self.conns[conn]
+            self.bus_send('*', {'op': 'disconnect', 'conn': conn})
+        self.forwarded.pop(client_socket, None)
+        super().close_client(client_socket)
+
+    def handle_existing_conn(self, notified_socket):
+        if notified_socket is self.bus_socket:
+            return self.handle_bus()
+        return super().handle_existing_conn(notified_socket)
+
+    # Routing
+    def holding(self, client_socket):
+        return client_socket in self.forwarded or super().holding(client_socket)
+
+    def read_list(self):
+        if not self.forwarded:
+            return super().read_list()
+        return [s for s in self.sockets_list if not self.holding(s)]
+
+    def owner_of(self, command, client_socket):
+        """
+        Worker that has to execute a command, or None if any worker can
+        answer it from its replica.
+        """
+        if command.name in ROOM_COMMANDS and command.room is not None:
+            return shard_of(command.room, self.workers)
+        if command.name == "$$list" and command.room not in (None, "all", "mine"):
+            return shard_of(command.room, self.workers)
+        if command.name == "$$exit":
+            room = self.registry.active_room(self.clients[client_socket].uid)
+            if room is not None:
+                return shard_of(room.name, self.workers)
+        return None
+
+    def run_command(self, client_socket, message):
+        """
+        Commands for rooms owned by another worker are forwarded to it,
+        already parsed.
+        The owner reports back when it is done, see end_replies, and the
+        client's next commands are held until then.
+        Commands that don't parse are answered here.
+        """
+        if not isinstance(client_socket, RemoteClient):
+            try:
+                command = self.parse(message)
+            except (CommandError, UnicodeDecodeError):
+                command = None
+            owner = self.owner_of(command, client_socket) if command is not None else None
+            if owner in self.gone:
+                self.log_and_send(client_socket, f"Worker {owner} holding this room is gone, {command.name} was not run")
+                self.end_replies(client_socket)
+                return
+            if owner is not None and owner != self.worker_id:
+                body = str(command.body, 'utf-8') if command.body is not None else None
+                self.bus_send(owner, {'op': 'command',
+                                      'conn': self.conn_ids[client_socket],
+                                      'command': command.name, 'args': command.args, 'body': body})
+                self.forwarded[client_socket] = owner
+                return
+        super().run_command(client_socket, message)
+
+    # Output to clients of other workers
+    def just_send(self, client_socket, msg):
+        if isinstance(client_socket, RemoteClient):
+            self.bus_send(client_socket.worker, {'op': 'reply', 'conn': client_socket.conn, 'msg': msg})
+            return
+        super().just_send(client_socket, msg)
+
+    def end_replies(self, client_socket):
+        if isinstance(client_socket, RemoteClient):
+            self.bus_send(client_socket.worker, {'op': 'done', 'conn': client_socket.conn})
+            return
+        super().end_replies(client_socket)
+
+    def broadcast(self, client_sockets, roomname, sending_user, body):
+        """
+        Local recipients get the encoded frame, each other worker holding
+        recipients gets one bus message listing its connections.
+        """
+        local = []
+        remote = {}
+        for client_socket in client_sockets:
+            if isinstance(client_socket, RemoteClient):
+                remote.setdefault(client_socket.worker, []).append(client_socket.conn)
+            else:
+                local.append(client_socket)
+        text = body if isinstance(body, str) or not remote else str(body, 'utf-8')
+        for worker, conns in remote.items():
+            self.bus_send(worker, {'op': 'deliver', 'conns': conns,
+                                   'room': roomname, 'user': sending_user, 'body': text})
+        count = super().broadcast(local, roomname, sending_user, body)
+        return count + sum(len(conns) for conns in remote.values())
+
+    # Replication
+    def replicate(self, op, room, user):
+        """
+        Registry listener: the owner of a room publishes each change to it.
+        """
+        if self.owns(room.name):
+            self.bus_send('*', {'op': 'event', 'event': op, 'room': room.name, 'user': user})
+
+    # Bus input
+    def handle_bus(self):
+        try:
+            data = self.bus_socket.recv(RECV_CHUNK)
+            messages = self.decoders[self.bus_socket].feed(data) if data else None
+        except (OSError, FramingError) as e:
+            log.warning("Bus read error %s", e)
+            messages = None
+        if messages is None:
+            log.error("Lost connection to the cluster bus, exiting")
+            sys.exit(1)
+        for message in messages:
+            _, _, body = message['data'].partition(b' ')
+            try:
+                self.handle_bus_message(json.loads(body))
+            except Exception as e:
+                log.error("Error handling bus message %s", e)
+        return True
+
+    def handle_bus_message(self, msg):
+        op = msg['op']
+        sender = msg['from']
+        if op == 'deliver':
+            local = [self.conns[conn] for conn in msg['conns'] if conn in self.conns]
+            Server.broadcast(self, local, msg['room'], msg['user'], msg['body'])
+        elif op == 'reply':
+            if msg['conn'] in self.conns:
+                self.just_send(self.conns[msg['conn']], msg['msg'])
+        elif op == 'done':
+            client_socket = self.conns.get(msg['conn'])
+            if client_socket is not None:
+                self.command_done(client_socket)
+        elif op == 'command':
+            remote = self.remotes.get((sender, msg['conn']))
+            if remote is not None:
+                body = msg['body'].encode('utf-8') if msg['body'] is not None else None
+                command = Command(COMMANDS[msg['command']], tuple(msg['args']), body=body)
+                self.run_command(remote, {'command': command})
+            else:
+                # The sender holds the client's next commands until this
+                self.bus_send(sender, {'op': 'done', 'conn': msg['conn']})
+        elif op == 'event':
+            self.apply_event(msg['event'], msg['room'], msg['user'])
+        elif op == 'connect':
+            remote = RemoteClient(sender, msg['conn'])
+            self.remotes[(sender, msg['conn'])] = remote
+            session = self.clients[remote] = Session(msg['user'])
+            self.registry.connect(session.uid, remote)
+        elif op == 'disconnect':
+            self.drop_remote((sender, msg['conn']))
+        elif op == 'gone':
+            self.worker_gone(msg['worker'])
+
+    def command_done(self, client_socket):
+        """
+        A forwarded command was handled, go on with the client's next ones.
+        """
+        self.end_replies(client_socket)
+        del self.forwarded[client_socket]
+        deferred = self.deferred.pop(client_socket, None)
+        if deferred:
+            self.handle_messages(client_socket, deferred)
+
+    def drop_remote(self, key):
+        remote = self.remotes.pop(key, None)
+        user = self.clients.pop(remote, None)
+        if user is not None:
+            self.registry.disconnect(user.uid, remote)
+
+    def worker_gone(self, worker):
+        """
+        Another worker was cut off the bus. Its users are disconnected,
+        and commands out at it won't be answered.
+        """
+        log.error("Worker %d is gone from the bus", worker)
+        self.gone.add(worker)
+        for key in [key for key in self.remotes if key[0] == worker]:
+            self.drop_remote(key)
+        for client_socket, owner in list(self.forwarded.items()):
+            if owner == worker:
+                self.just_send(client_socket, f"Worker {worker} holding this room is gone, the command may not have run")
+                self.command_done(client_socket)
+
+    def handle_terminate(self, sig, frame):
+        """
+        Workers share one replica of the rooms, worker 0 snapshots it.
+        """
+        if self.persist:
+            self.store.snapshot(self.registry.room_list())
+        self.history.flush()
+        stop_logging()
+        sys.exit(0)
+
+
+def run_worker(worker_id, workers, bus_path, args, log_level, metrics_socket):
+    setup_logging(log_level)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    s = WorkerServer(worker_id, workers, bus_path, *args)
+    if metrics_socket:
+        s.open_metrics_socket(f'{metrics_socket}.{worker_id}')
+    signal.signal(signal.SIGTERM, s.handle_terminate)
+    log.info("Worker %d of %d started, pid %d", worker_id, workers, os.getpid())
+    s.run()
+
+
+def run_cluster(workers, *args, log_level='info', metrics_socket=None):
+    """
+    Start the bus and the worker processes, then route bus traffic
+    until Ctrl+C, which stops the workers.
+    """
+    bus_path = os.path.join(tempfile.mkdtemp(prefix='tinyirc-'), 'bus.sock')
+    bus = Bus(bus_path, workers)
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=run_worker, args=(worker_id, workers, bus_path, args, log_level, metrics_socket))
+                 for worker_id in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        bus.run()
+    except KeyboardInterrupt:
+        log.info("Stopping workers...")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        os.unlink(bus_path)
+        os.rmdir(os.path.dirname(bus_path))
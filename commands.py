@@ -0,0 +1,223 @@
+# Lobby commands shared by the TinyIRC client and server.
+#
+# Every $$ command is described once, by a CommandSpec in COMMANDS: its name,
+# v2 opcode, parameters, the server method that handles it and its help
+# text. Frames are parsed once into a Command, which handlers read their
+# arguments from, and the server dispatches on the spec.
+#
+# Plugins add commands with register() or the @command decorator, giving a
+# function handler(server, command, client_socket) instead of a method name.
+
+
+class CommandError(ValueError):
+    """
+    Raised for a command that can't be parsed, the message says why
+    and is meant for the user.
+    """
+
+
+class CommandSpec:
+    """
+    Description of one command.
+
+    params names the arguments in order, the first required of them are
+    mandatory. With rest, the last parameter takes the remainder of the line.
+    handler is the name of a Server method, or a plugin function.
+    usage and help are what $$help shows.
+    rate_class and cost are what the command is charged against the
+    sender's rate limits, see ratelimit.py.
+    """
+    def __init__(self, name, opcode, handler, params=(), required=0, rest=False, usage=None, help='', missing=None,
+                 rate_class='control', cost=1):
+        self.name = name
+        self.opcode = opcode
+        self.handler = handler
+        self.params = tuple(params)
+        self.required = required
+        self.rest = rest
+        self.usage = usage if usage is not None else ' '.join(f"[{param}]" for param in self.params)
+        self.help = help
+        self.missing = missing or f"Must specify {' and '.join(self.params[:required])} to execute {name}!"
+        self.rate_class = rate_class
+        self.cost = cost
+
+    def parse(self, text):
+        if self.rest:
+            words = text.split(None, len(self.params))
+        else:
+            words = text.split()
+        return self.command(words[1:1 + len(self.params)])
+
+    def command(self, args):
+        if len(args) < self.required:
+            raise CommandError(self.missing)
+        return Command(self, tuple(args))
+
+
+class Command:
+    """
+    A parsed command. user and uid are filled in by the server with the
+    sender's name and interned id.
+
+    body is the message of a $$send as raw utf-8 bytes, when it was parsed
+    by parse_send or from v2 fields, instead of being the last of args.
+    """
+    __slots__ = ('spec', 'args', 'user', 'uid', 'body')
+
+    def __init__(self, spec, args, user=None, body=None):
+        self.spec = spec
+        self.args = args
+        self.user = user
+        self.uid = None
+        self.body = body
+
+    @property
+    def name(self):
+        return self.spec.name
+
+    @property
+    def room(self):
+        """
+        First argument, which for most commands is a room name.
+        """
+        return self.args[0] if self.args else None
+
+    def arg(self, i, default=None):
+        return self.args[i] if i < len(self.args) else default
+
+    @property
+    def text(self):
+        args = self.args if self.body is None else self.args + (str(self.body, 'utf-8'),)
+        return ' '.join((self.spec.name,) + args)
+
+    def __repr__(self):
+        return f"Command({self.text!r}, user={self.user!r})"
+
+
+COMMANDS = {}
+COMMAND_OPCODES = {}
+OPCODE_COMMANDS = {}
+
+SEND_PREFIX = b'$$send '
+
+
+def register(name, opcode, handler, **options):
+    """
+    Add a command, or replace the one of the same name.
+    """
+    if opcode in OPCODE_COMMANDS and OPCODE_COMMANDS[opcode] != name:
+        raise ValueError(f"Opcode {opcode:#x} is taken by {OPCODE_COMMANDS[opcode]}")
+    spec = CommandSpec(name, opcode, handler, **options)
+    COMMANDS[name] = spec
+    COMMAND_OPCODES[name] = opcode
+    OPCODE_COMMANDS[opcode] = name
+    return spec
+
+
+def command(name, opcode, **options):
+    """
+    Decorator registering a plugin function as the handler of a new command.
+    """
+    def decorate(handler):
+        register(name, opcode, handler, **options)
+        return handler
+    return decorate
+
+
+def parse_command(text):
+    """
+    Parse a command line such as '$$send pokemon hi all'.
+    """
+    words = text.split(None, 1)
+    if not words:
+        raise CommandError("Empty command")
+    spec = COMMANDS.get(words[0])
+    if spec is None:
+        raise CommandError(f"Unknown command {words[0]}")
+    return spec.parse(text)
+
+
+def parse_send(data):
+    """
+    Fast path for a text frame '$$send room message' received as bytes.
+    The message is kept as a memoryview of the frame with its bytes exactly
+    as sent, in Command.body. A message that isn't pure ASCII is decoded
+    once to check it is utf-8, but the string is thrown away.
+    Returns None for frames the full parser has to handle.
+    Raises UnicodeDecodeError if the frame isn't utf-8.
+    """
+    if not data.startswith(SEND_PREFIX):
+        return None
+    end = data.find(b' ', len(SEND_PREFIX))
+    room = data[len(SEND_PREFIX):end]
+    if end < 0 or room.split() != [room]:
+        return None
+    if not data.isascii():
+        data.decode('utf-8')
+    return Command(COMMANDS['$$send'], (room.decode('utf-8'),), body=memoryview(data)[end + 1:])
+
+
+def command_from_fields(opcode, fields):
+    """
+    Build a command from a v2 frame, its fields are already split.
+    The message of a $$send is kept as a memoryview of its field in
+    Command.body, like parse_send does.
+    """
+    name = OPCODE_COMMANDS.get(opcode)
+    if name is None:
+        return None
+    spec = COMMANDS[name]
+    if name == '$$send' and len(fields) > 1:
+        body = fields[1]
+        if not body.isascii():
+            body.decode('utf-8')
+        return Command(spec, (fields[0].decode('utf-8'),), body=memoryview(body))
+    return spec.command([field.decode('utf-8') for field in fields[:len(spec.params)]])
+
+
+register("$$whoami", 0x01, 'handle_whoami',
+         help="Echo your current identity")
+register("$$create", 0x02, 'handle_create_room', params=('room',), required=1,
+         usage="[room name]", help="Creates a new chat room with specified name",
+         missing="Must specify a room name argument to execute $$create or $$delete! [E.g. $$create pokemon]")
+register("$$delete", 0x03, 'handle_delete_room', params=('room',), required=1,
+         usage="[room name]", help="Allows a room Admin to delete a specified room",
+         missing="Must specify a room name argument to execute $$create or $$delete! [E.g. $$create pokemon]")
+register("$$join", 0x04, 'handle_join_room', params=('room',), required=1,
+         usage="[room name]", help="Add yourself to room membership, if possible",
+         missing="Must specify a room name argument to execute $$join or $$leave! [E.g. $$join pokemon]")
+register("$$leave", 0x05, 'handle_leave_room', params=('room',), required=1,
+         usage="[room name]", help="Remove yourself from room membership, if possible",
+         missing="Must specify a room name argument to execute $$join or $$leave! [E.g. $$join pokemon]")
+register("$$list", 0x06, 'handle_list_room', params=('room', 'cursor', 'limit'), rate_class='query', cost=5,
+         usage="[room name|mine|all] (cursor) (limit)",
+         help="Without an argument, lists available rooms\nwith an argument, list users in specified room or \n"
+              "rooms you've joined or all rooms with members\n"
+              "long lists come in pages, cursor and limit pick the page")
+register("$$enter", 0x07, 'handle_enter_room_session', params=('room',), required=1,
+         usage="[room name]", help="Enter an active session in a room, all messages will be directed to this room",
+         missing="Must specify a room name argument to execute $$enter! [E.g. $$enter pokemon]")
+register("$$exit", 0x08, 'handle_exit_room_session',
+         help="Exit an active room session, messages will default to lobby")
+register("$$send", 0x09, 'handle_send_to_room', params=('room', 'message'), required=1, rest=True, rate_class='send',
+         usage="[room name] (message)", help="Send a message to a specific room",
+         missing="Must specify a room to send your message for $$send [E.g. $$send pokemon]!")
+register("$$history", 0x0A, 'handle_history', params=('room', 'count'), required=1, rate_class='query', cost=5,
+         usage="[room name] (count)", help="Replay the last messages sent to a room you've joined",
+         missing="Must specify a room name argument to execute $$history! [E.g. $$history pokemon 50]")
+register("$$stats", 0x0B, 'handle_stats', rate_class='query', cost=5,
+         help="Server metrics, for server admins only")
+register("$$watch", 0x0C, 'handle_watch', params=('room',), required=1,
+         usage="[room name]", help="Get told whenever users join, leave, enter or exit a room",
+         missing="Must specify a room name argument to execute $$watch or $$unwatch! [E.g. $$watch pokemon]")
+register("$$unwatch", 0x0D, 'handle_unwatch', params=('room',), required=1,
+         usage="[room name]", help="Stop watching a room",
+         missing="Must specify a room name argument to execute $$watch or $$unwatch! [E.g. $$watch pokemon]")
+
+
+def help_lines():
+    lines = ["Available commands:"]
+    for spec in COMMANDS.values():
+        usage = f" {spec.usage}" if spec.usage else ''
+        lines.append(f"{spec.name}{usage} -- {spec.help}")
+    return lines
@@ -0,0 +1,80 @@
+from registry import USERS
+
+# Rendered room directory for $$list.
+#
+# The text listing a room's members is kept per room and only rebuilt after
+# that room's membership changed, so repeated $$list all requests cost a
+# join of cached strings. Listings are sent as a stream of frames of about
+# LIST_FRAME_BYTES each and paged with a cursor, the position in the
+# listing to start at, and a limit.
+
+LIST_FRAME_BYTES = 16 * 1024
+# Entries per page when the client gives no limit, and the most it may ask for
+LIST_PAGE = 500
+LIST_MAX = 5000
+
+# Changes that make a room's entry stale, entering and exiting don't show
+MEMBERSHIP_OPS = ('create', 'delete', 'join', 'leave')
+
+
+def frames(parts, size=LIST_FRAME_BYTES):
+    """
+    Join text parts into frames of about size characters, lazily.
+    Parts are never split, so a frame only goes over size when one
+    part does.
+    """
+    batch = []
+    length = 0
+    for part in parts:
+        if batch and length + len(part) > size:
+            yield ''.join(batch)
+            batch = []
+            length = 0
+        batch.append(part)
+        length += len(part)
+    if batch:
+        yield ''.join(batch)
+
+
+class Directory:
+    """
+    Memoised $$list rendering, fed with record() from a registry listener.
+
+        names:   room names in creation order, None when stale
+        entries: room name -> its rendered $$list all entry
+    """
+    def __init__(self, registry):
+        self.registry = registry
+        self.names = None
+        self.entries = {}
+
+    def record(self, op, room, user):
+        """
+        Registry listener: forget what a change made stale.
+        """
+        if op not in MEMBERSHIP_OPS:
+            return
+        if op == 'create' or op == 'delete':
+            self.names = None
+        self.entries.pop(room.name, None)
+
+    def room_names(self):
+        if self.names is None:
+            self.names = list(self.registry.rooms)
+        return self.names
+
+    def entry(self, room):
+        """
+        A room and its members, admins marked.
+        """
+        text = self.entries.get(room.name)
+        if text is None:
+            members = ''.join(f"\t{USERS.name(uid)}{' - Admin' if room.is_admin(uid) else ''}\n"
+                              for uid in room.members)
+            text = self.entries[room.name] = f'Room: {room.name}\nUsers: {members}\n'
+        return text
+
+    def entries_from(self, names):
+        rooms = self.registry.rooms
+        for name in names:
+            yield self.entry(rooms[name])
@@ -0,0 +1,474 @@
+import json
+import socket
+
+from framing import FrameDecoder, FramingError, RECV_CHUNK, encode_frame
+from outbound import OutboundQueue, SlowConsumers, DROP, EVICT
+from persistence import room_record
+from server import Server, IP
+from registry import USERS
+from log import log
+
+# Server to server federation for TinyIRC.
+#
+# Servers link to each other over a separate link port, like the server
+# ports of classic IRC networks, so users can connect to any server of the
+# network and talk to users of every other:
+#
+#     python server.py --server-name a --link-port 7001
+#     python server.py --server-name b --port 9002 --link 127.0.0.1:7001
+#
+# The links must form a spanning tree. Each link handshake carries the
+# names of every server on both sides, and a link that would reach a server
+# already on the network is refused, so there is exactly one path between
+# any two servers. Anything forwarded on every link but the one it came in
+# on therefore reaches each server once, without loops or duplicate checks.
+#
+# When two servers link they send each other a burst of their state: the
+# users connected on their side and every room with its members and active
+# users. After that each room change is propagated as an event, so every
+# server holds a full replica of the room directory, like cluster workers do.
+# Commands run on the server the user is connected to. A $$send is relayed
+# only on links leading to servers where members of the room are connected,
+# and each of those relays it on the same way.
+#
+# Concurrent changes made on two servers are merged, the same room created
+# on both sides of a link is one room. Two users of the same name on both
+# sides are not, the name stays with the user who was there first.
+#
+# A link whose peer doesn't keep up is handled like a slow consumer, see
+# SlowConsumers: once its backlog passes the high watermark it is lagging,
+# room messages relayed over it are dropped when it lags too long or too
+# far, and past the eviction limits the link is dropped, splitting the
+# network. Reads from a link are never paused for its backlog, the two
+# ends pausing each other would deadlock.
+#
+# Link frames use the normal 10 byte header framing with a JSON payload.
+
+
+def link_frame(msg):
+    return encode_frame(json.dumps(msg).encode('utf-8'))
+
+
+def parse_link(text):
+    """
+    'HOST:PORT' from the command line.
+    """
+    host, _, port = text.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError(f"Links look like HOST:PORT, not {text!r}")
+    return host, int(port)
+
+
+class RemoteUser:
+    """
+    Stands in for the socket of a user connected to another server.
+
+    Kept in registry.users so room members connected anywhere on the network
+    are recipients of $$send. server is where the user is connected and
+    link the link leading towards it.
+    """
+    __slots__ = ('server', 'link')
+
+    def __init__(self, server, link):
+        self.server = server
+        self.link = link
+
+    def __repr__(self):
+        return f"RemoteUser(server={self.server!r})"
+
+
+class LinkedServer(Server):
+    """
+    A server of a federated network. Serves its own clients with the
+    select engine and shares rooms with the servers it is linked to.
+
+        links:  server name -> socket of a direct link to it
+        peers:  link socket -> name of the server at the other end, None
+                until its handshake arrived
+        routes: server name -> link leading to it, for every other server
+                on the network
+    """
+    def __init__(self, server_name, link_port, links, *args):
+        self.server_name = server_name
+        super().__init__(*args)
+        self.links = {}
+        self.peers = {}
+        self.routes = {}
+        # Links this server opened, the other end answers their handshake
+        self.outgoing = set()
+        # Accepted links waiting for the burst that completes the handshake,
+        # with the servers behind them
+        self.pending = {}
+        # Link whose changes are being applied, they aren't sent back to it
+        self.source = None
+        # Set while applying a netsplit every server applies by itself
+        self.quiet = False
+        # Links whose peer doesn't keep up with what is sent to it
+        self.lagging_links = SlowConsumers()
+        self.registry.listeners.append(self.propagate)
+
+        self.link_listen_socket = None
+        if link_port is not None:
+            self.link_listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.link_listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.link_listen_socket.bind((IP, link_port))
+            self.link_listen_socket.listen()
+            self.sockets_list.append(self.link_listen_socket)
+            log.info("Server %s accepting links on port %d", server_name, link_port)
+        for host, port in links:
+            self.connect_link(host, port)
+
+    def store_path(self):
+        """
+        Servers on one machine each keep their own replica.
+        """
+        return f"{super().store_path()[:-len('.d')]}-{self.server_name}.d"
+
+    # Link connections
+    def connect_link(self, host, port):
+        try:
+            link = socket.create_connection((host, port))
+        except OSError as e:
+            log.error("Could not link to %s:%d: %s", host, port, e)
+            return
+        log.info("Linking to %s:%d", host, port)
+        self.add_link(link)
+        self.outgoing.add(link)
+        self.link_send(link, self.hello())
+
+    def accept_link(self):
+        link, address = self.link_listen_socket.accept()
+        log.info("Link connection from %s:%s", address[0], address[1])
+        self.add_link(link)
+
+    def add_link(self, link):
+        link.setblocking(False)
+        self.peers[link] = None
+        self.sockets_list.append(link)
+        self.decoders[link] = FrameDecoder()
+        self.outbound[link] = OutboundQueue(self.write_stats)
+
+    def hello(self):
+        return {'op': 'server', 'name': self.server_name, 'servers': [self.server_name, *self.routes]}
+
+    def link_send(self, link, msg):
+        """
+        Queue a message for a linked server. Room messages may be dropped
+        for a lagging link, and a link past the eviction limits is dropped.
+        """
+        queue = self.outbound.get(link)
+        if queue is None:
+            return
+        lagging = self.lagging_links
+        if link in lagging.lagging:
+            if msg['op'] == 'message':
+                verdict = lagging.verdict(link, len(queue))
+            else:
+                verdict = EVICT if lagging.evicting(link, len(queue)) else None
+            if verdict == DROP:
+                self.metrics.slow_consumer('dropped', f"server {self.peers[link]}")
+                return
+            if verdict == EVICT:
+                log.error("Dropping link to %s: %d bytes unsent, lagging for %.1fs",
+                          self.peers[link], len(queue), lagging.lag(link))
+                self.metrics.slow_consumer('evicted', f"server {self.peers[link]}")
+                self.close_client(link)
+                return
+        queue.append(link_frame(msg))
+        if link not in self.blocked_writes:
+            self.pending_writes.add(link)
+        if len(queue) > self.high_watermark and link not in lagging.lagging:
+            log.warning("Outbound backlog of %d bytes on the link to %s", len(queue), self.peers[link])
+            lagging.start(link)
+
+    def handle_writes(self, write_sockets):
+        """
+        A lagging link that drained below the low watermark caught up.
+        """
+        super().handle_writes(write_sockets)
+        for link in write_sockets:
+            if link in self.lagging_links.lagging and self.backlog(link) <= self.low_watermark:
+                dropped = self.lagging_links.stop(link)
+                log.info("Link to %s caught up, %d room messages were dropped", self.peers.get(link), dropped)
+
+    def forward(self, msg, source=None):
+        """
+        Send a message on every link but the one it came from.
+        """
+        for link in list(self.links.values()):
+            if link is not source:
+                self.link_send(link, msg)
+
+    def handle_existing_conn(self, notified_socket):
+        if notified_socket is self.link_listen_socket:
+            self.accept_link()
+            return True
+        if notified_socket in self.peers:
+            return self.handle_link(notified_socket)
+        return super().handle_existing_conn(notified_socket)
+
+    def handle_link(self, link):
+        try:
+            data = link.recv(RECV_CHUNK)
+            messages = self.decoders[link].feed(data) if data else None
+        except (OSError, FramingError) as e:
+            log.warning("Link read error %s", e)
+            messages = None
+        if messages is None:
+            self.close_client(link)
+            return False
+        for message in messages:
+            if link not in self.peers:
+                # Closed by an earlier message
+                break
+            try:
+                self.handle_link_message(link, json.loads(message['data']))
+            except Exception as e:
+                log.error("Error handling link message %s", e)
+        return True
+
+    def close_client(self, client_socket):
+        """
+        A lost link splits the network: the servers behind it are gone,
+        along with the connections of their users.
+        """
+        if client_socket not in self.peers:
+            session = self.clients.get(client_socket)
+            super().close_client(client_socket)
+            if session is not None and session.uid not in self.registry.users:
+                self.forward({'op': 'disconnect', 'user': session.name})
+            return
+        name = self.peers.pop(client_socket)
+        self.outgoing.discard(client_socket)
+        self.pending.pop(client_socket, None)
+        self.sockets_list.remove(client_socket)
+        self.decoders.pop(client_socket, None)
+        self.outbound.pop(client_socket, None)
+        self.pending_writes.discard(client_socket)
+        self.blocked_writes.discard(client_socket)
+        self.lagging_links.stop(client_socket)
+        client_socket.close()
+        if name is None or self.links.get(name) is not client_socket:
+            return
+        del self.links[name]
+        gone = [server for server, link in self.routes.items() if link is client_socket]
+        log.warning("Lost link to %s, servers split off: %s", name, ', '.join(gone))
+        self.split(gone)
+        self.forward({'op': 'squit', 'servers': gone})
+
+    def split(self, servers):
+        """
+        Forget servers no longer on the network and disconnect their users.
+        Every server does this by itself, so nothing is propagated.
+        """
+        servers = set(servers)
+        for server in servers:
+            self.routes.pop(server, None)
+        users = self.registry.users
+        self.quiet = True
+        try:
+            for uid, user_socket in list(users.items()):
+                if isinstance(user_socket, RemoteUser) and user_socket.server in servers:
+                    self.registry.disconnect(uid, user_socket)
+        finally:
+            self.quiet = False
+
+    # Handshake and burst
+    def handle_link_message(self, link, msg):
+        op = msg['op']
+        if op == 'server':
+            self.handle_hello(link, msg)
+            return
+        if op == 'error':
+            log.error("Link refused: %s", msg['reason'])
+            self.close_client(link)
+            return
+        if op == 'burst' and link in self.pending:
+            if not self.activate(link, self.peers[link], self.pending.pop(link)):
+                return
+        elif link not in self.links.values():
+            self.refuse(link, f"Link sent {op} before its handshake")
+            return
+        self.source = link
+        try:
+            self.handle_peer_message(link, msg)
+        finally:
+            self.source = None
+
+    def handle_hello(self, link, msg):
+        """
+        The handshake: the connecting server introduces itself with the
+        servers on its side, the accepting one answers in kind. The
+        connecting server links up when the answer arrives and sends its
+        burst, the accepting one when that burst arrives. Each end checks
+        the other's servers before linking up, see activate.
+        """
+        name = msg['name']
+        if self.peers[link] is not None:
+            self.refuse(link, f"Server {name} sent a second handshake")
+            return
+        self.peers[link] = name
+        if link in self.outgoing:
+            self.activate(link, name, msg['servers'])
+        elif self.loops(msg['servers']):
+            self.refuse(link, f"Server {name} is already on the network of {self.server_name}, links must form a tree")
+        else:
+            self.pending[link] = msg['servers']
+            self.link_send(link, self.hello())
+
+    def loops(self, servers):
+        """
+        Whether linking to these servers would close a loop.
+        """
+        return self.server_name in servers or any(server in self.routes for server in servers)
+
+    def activate(self, link, name, servers):
+        """
+        Link up with a server and the servers behind it, then send it our
+        burst. Returns False if the network changed since the handshake
+        began and the link would now close a loop.
+        """
+        if self.loops(servers):
+            self.refuse(link, f"Server {name} is already on the network of {self.server_name}, links must form a tree")
+            return False
+        self.links[name] = link
+        for server in servers:
+            self.routes[server] = link
+        log.info("Linked to server %s, %d servers behind it", name, len(servers))
+        self.forward({'op': 'servers', 'servers': servers}, link)
+        self.link_send(link, self.burst())
+        return True
+
+    def refuse(self, link, reason):
+        log.error("Refusing link: %s", reason)
+        self.link_send(link, {'op': 'error', 'reason': reason})
+        if link in self.peers:
+            self.flush_client(link)
+            self.close_client(link)
+
+    def burst(self):
+        """
+        Everything a newly linked server needs to know about this side
+        of the network.
+        """
+        users = [[USERS.name(uid), user_socket.server if isinstance(user_socket, RemoteUser) else self.server_name]
+                 for uid, user_socket in self.registry.users.items()]
+        rooms = [{**room_record(room), 'active': [USERS.name(uid) for uid in room.active]}
+                 for room in self.registry.rooms.values()]
+        return {'op': 'burst', 'users': users, 'rooms': rooms}
+
+    def apply_burst(self, link, msg):
+        """
+        Merge the other side's state into ours. The registry listener
+        propagates whatever is new here to the rest of our side.
+        """
+        for user, server in msg['users']:
+            self.connect_remote(link, user, server)
+        for record in msg['rooms']:
+            name = record['name']
+            self.apply_event('create', name, record['creator'])
+            for user in record['members']:
+                self.apply_event('join', name, user)
+            for user in record['active']:
+                self.apply_event('enter', name, user)
+
+    def connect_remote(self, link, user, server):
+        uid = USERS.id(user)
+        if uid in self.registry.users:
+            log.warning("User %s of server %s is already connected, keeping the first", user, server)
+            return
+        self.registry.connect(uid, RemoteUser(server, link))
+        self.forward({'op': 'connect', 'user': user, 'server': server}, link)
+
+    # Network traffic
+    def handle_peer_message(self, link, msg):
+        op = msg['op']
+        if op == 'burst':
+            self.apply_burst(link, msg)
+        elif op == 'event':
+            self.apply_event(msg['event'], msg['room'], msg['user'])
+        elif op == 'message':
+            self.relay(link, msg['room'], msg['user'], msg['body'])
+        elif op == 'connect':
+            self.connect_remote(link, msg['user'], msg['server'])
+        elif op == 'disconnect':
+            uid = USERS.find(msg['user'])
+            user_socket = self.registry.users.get(uid)
+            if isinstance(user_socket, RemoteUser) and user_socket.link is link:
+                self.quiet = True
+                try:
+                    self.registry.disconnect(uid, user_socket)
+                finally:
+                    self.quiet = False
+                self.forward(msg, link)
+        elif op == 'servers':
+            if self.loops(msg['servers']):
+                self.refuse(link, f"Servers {', '.join(msg['servers'])} are already on the network of "
+                                  f"{self.server_name}, links formed a loop through {self.peers[link]}")
+                return
+            for server in msg['servers']:
+                self.routes[server] = link
+            self.forward(msg, link)
+        elif op == 'squit':
+            self.split(msg['servers'])
+            self.forward(msg, link)
+
+    def propagate(self, op, room, user):
+        """
+        Registry listener: publish each room change to the rest of the network.
+        """
+        if not self.quiet and self.links:
+            self.forward({'op': 'event', 'event': op, 'room': room.name, 'user': user}, self.source)
+
+    def relay(self, link, roomname, sending_user, body):
+        """
+        A message sent on another server, for the members of the room
+        connected here or further along.
+        """
+        room = self.registry.get(roomname)
+        if room is None:
+            return
+        self.history.append(roomname, sending_user, body)
+        users = self.registry.users
+        sender = USERS.find(sending_user)
+        recipients = [users[member] for member in room.online if member != sender]
+        self.broadcast(recipients, roomname, sending_user, body)
+
+    def broadcast(self, client_sockets, roomname, sending_user, body):
+        """
+        Local recipients get the encoded frame, each link leading to
+        remote recipients gets the message once.
+        """
+        local = []
+        links = set()
+        remote = 0
+        for client_socket in client_sockets:
+            if isinstance(client_socket, RemoteUser):
+                if client_socket.link is not self.source:
+                    links.add(client_socket.link)
+                    remote += 1
+            else:
+                local.append(client_socket)
+        if links:
+            text = body if isinstance(body, str) else str(body, 'utf-8')
+            msg = {'op': 'message', 'room': roomname, 'user': sending_user, 'body': text}
+            for link in links:
+                self.link_send(link, msg)
+        return super().broadcast(local, roomname, sending_user, body) + remote
+
+    # Local users
+    def finish_handshake(self, client_socket, message):
+        if not super().finish_handshake(client_socket, message):
+            return False
+        user = self.clients[client_socket].name
+        self.forward({'op': 'connect', 'user': user, 'server': self.server_name})
+        return True
+
+    def name_taken(self, name):
+        """
+        A name connected on another server is taken.
+        """
+        user_socket = self.registry.users.get(USERS.find(name))
+        if isinstance(user_socket, RemoteUser):
+            return f"User {name} is already connected to server {user_socket.server}"
+        return None
@@ -0,0 +1,401 @@
+import functools
+import zlib
+
+from commands import CommandError, OPCODE_COMMANDS, command_from_fields
+from presence import describe
+
+# Wire framing shared by the TinyIRC client and server.
+# Every frame is a 10 byte, space padded ASCII length header followed by
+# that many bytes of utf-8 payload.
+#
+# Clients that list 'zlib' in their username frame may be sent compressed
+# frames: payloads of COMPRESS_THRESHOLD bytes or more are deflated and the
+# last header byte is 'z' instead of a space. Only the server compresses.
+
+HEADER_LENGTH = 10
+RECV_CHUNK = 65536
+
+COMPRESS_THRESHOLD = 1024
+# Fast setting, room and member listings compress well even so
+COMPRESS_LEVEL = 1
+
+# Room messages with a body this long or longer are queued as a small
+# header plus a view of the body in the sender's frame, shared by every
+# recipient. Shorter ones are copied into a single frame, which is cheaper
+# to queue and write than several pieces.
+SPLICE_MIN = 512
+# Room name prefixes kept encoded, per codec
+ROOM_PREFIXES = 4096
+
+
+class FramingError(Exception):
+    """
+    Raised when the peer sends a header that is not a valid length.
+    The stream can't be resynchronised after that, so drop the connection.
+    """
+
+
+def encode_frame(payload, compress=False):
+    """
+    Prefix a utf-8 encoded payload with its length header.
+    With compress, large payloads are sent deflated if that makes them smaller.
+    """
+    if compress and len(payload) >= COMPRESS_THRESHOLD:
+        packed = zlib.compress(payload, COMPRESS_LEVEL)
+        if len(packed) < len(payload):
+            return f"{len(packed):<{HEADER_LENGTH - 1}}z".encode('utf-8') + packed
+    return f"{len(payload):<{HEADER_LENGTH}}".encode('utf-8') + payload
+
+
+def is_compressed(message_header):
+    return message_header[-1:] == b'z'
+
+
+def parse_header(message_header, inflate=False):
+    if inflate and is_compressed(message_header):
+        message_header = message_header[:-1]
+    try:
+        message_length = int(message_header)
+    except ValueError:
+        raise FramingError(f"Invalid frame header {bytes(message_header)!r}")
+    if message_length < 0:
+        raise FramingError(f"Negative frame length {message_length}")
+    return message_length
+
+
+class FrameDecoder:
+    """
+    Incremental frame decoder holding the receive buffer of one connection.
+
+    Feed it whatever recv returned, however the bytes happen to be split,
+    and it hands back every frame completed by that read. Bytes belonging
+    to a frame that is not complete yet stay buffered for the next feed.
+
+    With inflate, compressed frames are accepted and decompressed.
+    With limit, frames longer than that raise FramingError.
+    """
+    def __init__(self, inflate=False, limit=None):
+        self.buffer = bytearray()
+        self.inflate = inflate
+        self.limit = limit
+
+    def feed(self, data):
+        """
+        Append data to the buffer and return the completed messages
+        as a list of {'header', 'data'} dicts, oldest first.
+        """
+        buffer = self.buffer
+        buffer += data
+        messages = []
+        pos = 0
+        while len(buffer) - pos >= HEADER_LENGTH:
+            message_header = bytes(buffer[pos:pos + HEADER_LENGTH])
+            length = parse_header(message_header, self.inflate)
+            if self.limit is not None and length > self.limit:
+                raise FramingError(f"Frame of {length} bytes is over the limit of {self.limit}")
+            end = pos + HEADER_LENGTH + length
+            if len(buffer) < end:
+                break
+            data = bytes(buffer[pos + HEADER_LENGTH:end])
+            if self.inflate and is_compressed(message_header):
+                data = inflate(data)
+            messages.append({"header": message_header, "data": data})
+            pos = end
+        if pos:
+            del buffer[:pos]
+        return messages
+
+
+def inflate(data):
+    try:
+        return zlib.decompress(data)
+    except zlib.error as e:
+        raise FramingError(f"Corrupt compressed frame: {e}")
+
+
+def split_frame(buffer, limit=None):
+    """
+    The first frame in buffer as a {'header', 'data'} dict and the bytes
+    after it, or None if the frame isn't complete yet. Raises FramingError
+    for a frame longer than limit.
+    """
+    if len(buffer) < HEADER_LENGTH:
+        return None
+    message_header = bytes(buffer[:HEADER_LENGTH])
+    length = parse_header(message_header)
+    if limit is not None and length > limit:
+        raise FramingError(f"Frame of {length} bytes is over the limit of {limit}")
+    end = HEADER_LENGTH + length
+    if len(buffer) < end:
+        return None
+    return {"header": message_header, "data": bytes(buffer[HEADER_LENGTH:end])}, bytes(buffer[end:])
+
+
+def recv_exactly(sock, n):
+    """
+    Blocking read of exactly n bytes, however many recv calls that takes.
+    """
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed mid frame")
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(sock):
+    """
+    Blocking read of a single frame. Only reads the bytes of that frame,
+    so anything pipelined behind it is left in the socket.
+    """
+    message_header = recv_exactly(sock, HEADER_LENGTH)
+    return {"header": message_header, "data": recv_exactly(sock, parse_header(message_header))}
+
+
+# Protocol v2
+#
+# Compact binary framing, negotiated in the username handshake: a client
+# lists 'v2' after its name ("alice v2") and switches once the server acks
+# with a legacy framed "$$caps v2" message. Clients that don't ask keep
+# the text protocol above.
+#
+#   frame := varint(len(body)) body
+#   body  := opcode field*
+#           | (opcode | FLAG_COMPRESSED) deflate(field*)
+#   field := varint(len(bytes)) bytes
+#
+# Client to server opcodes name the $$ command, its arguments are the fields.
+# Server to client frames are a reply to the current command, a chat
+# message relayed from a room, a presence update for a watched room, or
+# the end marker sent once a command has been handled, which lets clients
+# match replies to their commands. Commands are handled one at a time in
+# the order they were sent, clustered servers included, so the end markers
+# come back in that order too.
+
+MAX_VARINT_BYTES = 5
+
+# Command opcodes are assigned in the command registry, see commands.py
+
+OP_REPLY = 0x80     # [text]
+OP_MESSAGE = 0x81   # [room, user, body]
+OP_DONE = 0x82      # []
+OP_PRESENCE = 0x83  # [room, (op, space separated users)*]
+
+FLAG_COMPRESSED = 0x40
+
+
+def encode_varint(n):
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def decode_varint(buffer, pos):
+    """
+    Returns (value, position after the varint), or None if the buffer
+    ends before the varint does.
+    """
+    value = 0
+    shift = 0
+    for i in range(pos, min(len(buffer), pos + MAX_VARINT_BYTES)):
+        byte = buffer[i]
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, i + 1
+        shift += 7
+    if len(buffer) - pos >= MAX_VARINT_BYTES:
+        raise FramingError("Varint too long")
+    return None
+
+
+def encode_v2(opcode, *fields, compress=False):
+    """
+    Build a v2 frame, fields may be str or bytes.
+    With compress, large frames are sent deflated if that makes them smaller.
+    """
+    body = bytearray((opcode,))
+    for field in fields:
+        if isinstance(field, str):
+            field = field.encode('utf-8')
+        body += encode_varint(len(field))
+        body += field
+    if compress and len(body) > COMPRESS_THRESHOLD:
+        packed = zlib.compress(body[1:], COMPRESS_LEVEL)
+        if len(packed) + 1 < len(body):
+            body = bytes((opcode | FLAG_COMPRESSED,)) + packed
+    return encode_varint(len(body)) + body
+
+
+def decode_fields(body, pos=1):
+    fields = []
+    while pos < len(body):
+        decoded = decode_varint(body, pos)
+        if decoded is None:
+            raise FramingError("Truncated field length")
+        length, pos = decoded
+        if pos + length > len(body):
+            raise FramingError("Field overruns frame")
+        fields.append(bytes(body[pos:pos + length]))
+        pos += length
+    return fields
+
+
+class V2FrameDecoder:
+    """
+    Incremental decoder for v2 frames, the counterpart of FrameDecoder.
+    Messages come back as {'opcode', 'fields'} dicts.
+
+    With inflate, compressed frames are accepted and decompressed.
+    """
+    def __init__(self, buffer=b'', inflate=False):
+        self.buffer = bytearray(buffer)
+        self.inflate = inflate
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        messages = []
+        pos = 0
+        while pos < len(buffer):
+            decoded = decode_varint(buffer, pos)
+            if decoded is None:
+                break
+            length, start = decoded
+            end = start + length
+            if len(buffer) < end:
+                break
+            if not length:
+                raise FramingError("Empty v2 frame")
+            messages.append(self.message(buffer[start:end]))
+            pos = end
+        if pos:
+            del buffer[:pos]
+        return messages
+
+    def message(self, body):
+        opcode = body[0]
+        if self.inflate and opcode & FLAG_COMPRESSED and opcode & 0x80:
+            return {"opcode": opcode & ~FLAG_COMPRESSED, "fields": decode_fields(inflate(body[1:]), 0)}
+        return {"opcode": opcode, "fields": decode_fields(body)}
+
+
+class V2CommandDecoder(V2FrameDecoder):
+    """
+    Server side v2 decoder. Each message also carries the parsed Command
+    under 'command', built from the fields since they are already split.
+    Messages that don't make a valid command carry the equivalent text
+    command under 'data' instead, as the legacy decoder produces, for the
+    server to parse and report.
+    """
+    def message(self, body):
+        message = super().message(body)
+        name = OPCODE_COMMANDS.get(message['opcode'])
+        if name is None:
+            raise FramingError(f"Unknown opcode {message['opcode']:#x}")
+        try:
+            message['command'] = command_from_fields(message['opcode'], message['fields'])
+        except (CommandError, UnicodeDecodeError):
+            message['data'] = b' '.join([name.encode('utf-8')] + message['fields'])
+        return message
+
+
+class LegacyCodec:
+    """
+    Server side encoding for the original text protocol.
+    """
+    name = 'v1'
+
+    def __init__(self, compress=False):
+        self.compress = compress
+
+    def decoder(self):
+        return FrameDecoder()
+
+    def reply(self, msg):
+        return encode_frame(msg.encode('utf-8'), self.compress)
+
+    def message(self, room, user, body):
+        """
+        body may be str or utf-8 bytes. A long one is returned as a tuple
+        of (header, body, newline) for the outbound queue, see SPLICE_MIN.
+        """
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        head = self.room_prefix(room) + user.encode('utf-8') + b': '
+        if self.compress or len(body) < SPLICE_MIN:
+            return encode_frame(b''.join((head, body, b'\n')), self.compress)
+        return f"{len(head) + len(body) + 1:<{HEADER_LENGTH}}".encode('utf-8') + head, body, b'\n'
+
+    @functools.lru_cache(maxsize=ROOM_PREFIXES)
+    def room_prefix(self, room):
+        return f"[{room}] ".encode('utf-8')
+
+    def presence(self, room, changes):
+        return encode_frame(f"[{room}] * {describe(changes)}\n".encode('utf-8'), self.compress)
+
+    def done(self):
+        return None
+
+
+class V2Codec:
+    """
+    Server side encoding for protocol v2.
+    """
+    name = 'v2'
+
+    def __init__(self, compress=False):
+        self.compress = compress
+
+    def decoder(self):
+        return V2CommandDecoder()
+
+    def reply(self, msg):
+        return encode_v2(OP_REPLY, msg, compress=self.compress)
+
+    def message(self, room, user, body):
+        """
+        Like LegacyCodec.message, a long body comes back as (header, body).
+        """
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if self.compress or len(body) < SPLICE_MIN:
+            return encode_v2(OP_MESSAGE, room, user, body, compress=self.compress)
+        user = user.encode('utf-8')
+        head = bytearray((OP_MESSAGE,))
+        head += self.room_field(room)
+        head += encode_varint(len(user))
+        head += user
+        head += encode_varint(len(body))
+        return encode_varint(len(head) + len(body)) + head, body
+
+    @functools.lru_cache(maxsize=ROOM_PREFIXES)
+    def room_field(self, room):
+        """
+        The room field of a message, length included.
+        """
+        room = room.encode('utf-8')
+        return encode_varint(len(room)) + room
+
+    def presence(self, room, changes):
+        fields = [field for op, users in changes for field in (op, ' '.join(users))]
+        return encode_v2(OP_PRESENCE, room, *fields, compress=self.compress)
+
+    def done(self):
+        return DONE_FRAME
+
+
+DONE_FRAME = encode_v2(OP_DONE)
+LEGACY = LegacyCodec()
+CODECS = {(codec.name, codec.compress): codec
+          for codec in (LEGACY, LegacyCodec(compress=True), V2Codec(), V2Codec(compress=True))}
+
+
+def codec_for(caps):
+    """
+    Server side codec for the capabilities a client negotiated.
+    """
+    return CODECS[('v2' if 'v2' in caps else 'v1', 'zlib' in caps)]
@@ -3,11 +3,11 @@ import sys
 import os
 import json
 
+from commands import COMMANDS, CommandError, help_lines, parse_command
+
 # Helper module that Validates input client side to save server work
 # also handles client config
 
-accepted_commands = ["$$whoami", "$$create", "$$delete", "$$join", "$$leave", "$$list", "$$enter", "$$exit", "$$send"]
-
 def interpret_lobby_message(Client, message):
     """
     Filter invalid client messages and validate accepted commands.
@@ -17,9 +17,9 @@ def interpret_lobby_message(Client, message):
 
     message = message.strip()
     words = message.split()
+    if not words:
+        return None
     command = words[0]
-    if len(words) > 1:
-        room = words[1]
     # not special message
     if command[:2] != '$$' and not Client.entered:
         print("Unknown lobby input, please enter a valid command.")
@@ -27,23 +27,22 @@ def interpret_lobby_message(Client, message):
         #Debugging print(f"We received command {command}\n")
         return None
     elif command == "$$help":
-        print("Available commands:")
-        print("$$whoami -- Echo your current identity")
-        print("$$create [room name] -- Creates a new chat room with specified name")
-        print("$$delete [room name] -- Allows a room Admin to delete a specified room")
-        print("$$join [room name] -- Add yourself to room membership, if possible")
-        print("$$leave [room name] -- Remove yourself from room membership, if possible")
-        print("$$list [room name|mine|all] -- Without an argument, lists available rooms\nwith an argument, list users in specified room or \nrooms you've joined or all rooms with members")
-        print("$$enter [room name] -- Enter an active session in a room, all messages will be directed to this room")
-        print("$$exit -- Exit an active room session, messages will default to lobby")
-        print("$$send [room name] (message) -- Send a message to a specific room")
+        for line in help_lines():
+            print(line)
         print("$$$end -- Note three dollar signs, this will end the client session entirely\n")
         return None
-    elif command in accepted_commands or Client.entered:
+    elif command in COMMANDS:
+        try:
+            parsed = parse_command(message)
+        except CommandError as e:
+            print(e)
+            return None
         if command == "$$create":
-            if len(room) > 48 or not room.isalpha():
+            if len(parsed.room) > 48 or not parsed.room.isalpha():
                 print("Invalid! Room names must be 48 characters or less and alphabetical")
         return True
+    elif Client.entered:
+        return True
     else:
         print("Hmmm, you were close to a valid command with $$, are you sure this wasn't a typo?\n")
         print(f"We got {message}")
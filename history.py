@@ -0,0 +1,231 @@
+import collections
+import itertools
+import mmap
+import os
+import shutil
+import struct
+
+# Per room message history for the TinyIRC server.
+#
+# The newest messages of a room are held in memory, up to HISTORY_BUDGET
+# bytes. Older ones spill into append-only segment files on disk:
+#
+#     <seq>.log    message records back to back
+#     <seq>.idx    one little endian u64 per record, the offset its record ends at
+#
+# Segments are read through mmap. Because the index has a fixed record size,
+# the last N messages of a segment are found with one seek into the index
+# and one slice of the data, however long the room's history is.
+#
+# A room keeps at most MAX_SEGMENTS segments of SEGMENT_SIZE bytes, the
+# oldest is deleted when a new one is started. History is best effort: it is
+# not fsynced and whatever is still in memory is lost if the server is killed.
+
+HISTORY_BUDGET = 64 * 1024
+SEGMENT_SIZE = 1024 * 1024
+MAX_SEGMENTS = 16
+
+# Messages replayed by $$history when no count is given, and at most
+HISTORY_DEFAULT = 20
+HISTORY_MAX = 500
+
+OFFSET = struct.Struct('<Q')
+
+
+def encode_record(user, body):
+    """
+    body may be str or already utf-8 encoded bytes.
+    """
+    if isinstance(body, str):
+        return f"{user} {body}".encode('utf-8')
+    return b' '.join((user.encode('utf-8'), body))
+
+
+def decode_record(record):
+    user, _, body = bytes(record).decode('utf-8').partition(' ')
+    return user, body
+
+
+class Segment:
+    """
+    One pair of data and index files.
+    """
+    def __init__(self, path, seq):
+        self.seq = seq
+        self.data_path = os.path.join(path, f'{seq:08d}.log')
+        self.index_path = os.path.join(path, f'{seq:08d}.idx')
+        self.count = 0
+        self.size = 0
+        if os.path.exists(self.index_path):
+            self.recover()
+
+    def recover(self):
+        """
+        Cut both files back to the last complete record, in case the server
+        died part way through an append.
+        """
+        index_size = os.path.getsize(self.index_path)
+        self.count = index_size // OFFSET.size
+        if self.count:
+            with open(self.index_path, 'rb') as f:
+                f.seek((self.count - 1) * OFFSET.size)
+                self.size = OFFSET.unpack(f.read(OFFSET.size))[0]
+        for path, size in ((self.index_path, self.count * OFFSET.size), (self.data_path, self.size)):
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                with open(path, 'ab') as f:
+                    f.truncate(size)
+
+    def append(self, records):
+        offsets = []
+        end = self.size
+        for record in records:
+            end += len(record)
+            offsets.append(OFFSET.pack(end))
+        with open(self.data_path, 'ab') as f:
+            f.write(b''.join(records))
+        with open(self.index_path, 'ab') as f:
+            f.write(b''.join(offsets))
+        self.count += len(records)
+        self.size = end
+
+    def read(self, start, stop):
+        """
+        Records start up to stop of this segment.
+        """
+        if start >= stop:
+            return []
+        first = start - 1 if start else 0
+        with open(self.index_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as index:
+            ends = struct.unpack_from(f'<{stop - first}Q', index, first * OFFSET.size)
+        if start:
+            begin, ends = ends[0], ends[1:]
+        else:
+            begin = 0
+        records = []
+        with open(self.data_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for end in ends:
+                records.append(data[begin:end])
+                begin = end
+        return records
+
+    def remove(self):
+        for path in (self.data_path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class RoomHistory:
+    """
+    Ring buffer of a room's newest messages with the older ones on disk.
+    """
+    def __init__(self, path, budget=HISTORY_BUDGET):
+        self.path = path
+        self.budget = budget
+        self.ring = collections.deque()
+        self.ring_size = 0
+        self.segments = []
+        if os.path.isdir(path):
+            seqs = sorted(int(name[:-4]) for name in os.listdir(path) if name.endswith('.idx'))
+            self.segments = [Segment(path, seq) for seq in seqs]
+
+    def __len__(self):
+        return len(self.ring) + sum(segment.count for segment in self.segments)
+
+    def append(self, user, body):
+        record = encode_record(user, body)
+        self.ring.append(record)
+        self.ring_size += len(record)
+        if self.ring_size > self.budget:
+            # Spill down to half the budget so spills are batched
+            self.spill(self.budget // 2)
+
+    def spill(self, keep=0):
+        """
+        Move the oldest messages in memory to disk until at most keep bytes
+        are left in memory.
+        """
+        records = []
+        while self.ring and self.ring_size > keep:
+            record = self.ring.popleft()
+            self.ring_size -= len(record)
+            records.append(record)
+        while records:
+            segment = self.tail_segment()
+            room = SEGMENT_SIZE - segment.size
+            batch = 0
+            taken = 0
+            while batch < len(records) and (batch == 0 or taken + len(records[batch]) <= room):
+                taken += len(records[batch])
+                batch += 1
+            segment.append(records[:batch])
+            records = records[batch:]
+
+    def tail_segment(self):
+        if not self.segments or self.segments[-1].size >= SEGMENT_SIZE:
+            os.makedirs(self.path, exist_ok=True)
+            seq = self.segments[-1].seq + 1 if self.segments else 0
+            self.segments.append(Segment(self.path, seq))
+            while len(self.segments) > MAX_SEGMENTS:
+                self.segments.pop(0).remove()
+        return self.segments[-1]
+
+    def last(self, n):
+        """
+        The last n messages as (user, body) pairs, oldest first.
+        """
+        in_memory = min(n, len(self.ring))
+        records = list(itertools.islice(reversed(self.ring), in_memory))
+        records.reverse()
+        wanted = n - in_memory
+        for segment in reversed(self.segments):
+            if wanted <= 0:
+                break
+            start = max(segment.count - wanted, 0)
+            records[:0] = segment.read(start, segment.count)
+            wanted -= segment.count - start
+        return [decode_record(record) for record in records]
+
+    def remove(self):
+        self.ring.clear()
+        self.ring_size = 0
+        self.segments = []
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class History:
+    """
+    Histories of all rooms, under one directory with a subdirectory per room.
+
+    Room histories are opened on first use. Used as a registry listener,
+    a room's history is dropped when the room is created or deleted.
+    """
+    def __init__(self, path, budget=HISTORY_BUDGET):
+        self.path = path
+        self.budget = budget
+        self.rooms = {}
+
+    def room(self, name):
+        history = self.rooms.get(name)
+        if history is None:
+            # Room names come from clients, keep them out of the path
+            path = os.path.join(self.path, name.encode('utf-8').hex())
+            history = self.rooms[name] = RoomHistory(path, self.budget)
+        return history
+
+    def append(self, name, user, body):
+        self.room(name).append(user, body)
+
+    def last(self, name, n):
+        return self.room(name).last(n)
+
+    def flush(self):
+        """
+        Write everything still in memory to the segment files.
+        """
+        for history in self.rooms.values():
+            history.spill()
+
+    def record(self, op, room, user):
+        if op in ('create', 'delete'):
+            self.room(room.name).remove()
+            del self.rooms[room.name]
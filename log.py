@@ -0,0 +1,62 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+# Leveled logging for the TinyIRC server.
+#
+# Logging calls on the event loop only put the record on an in-memory queue
+# (queue.SimpleQueue, which takes no lock of its own); a background thread
+# formats the records and writes them out. Messages are passed %-style with
+# their arguments, so a call below the configured level returns before
+# anything is formatted, and an enabled one is formatted on the writer thread.
+#
+# Forked processes must call setup_logging again, the writer thread does not
+# survive a fork.
+
+LEVELS = ('debug', 'info', 'warning', 'error')
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+
+log = logging.getLogger('tinyirc')
+
+_listener = None
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue records untouched. The stock QueueHandler formats them before
+    queueing, which would put the formatting back on the caller.
+    """
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level='info', stream=None):
+    """
+    Send the server log, from the given level up, through a new queue and
+    writer thread to stream (stdout by default).
+    """
+    global _listener
+    stop_logging()
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+    log.handlers[:] = [DeferredQueueHandler(records)]
+    log.setLevel(level.upper())
+    log.propagate = False
+
+
+def stop_logging():
+    """
+    Write out everything still queued and stop the writer thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
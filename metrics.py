@@ -0,0 +1,177 @@
+import bisect
+import collections
+import time
+
+# Server metrics for TinyIRC.
+#
+# Everything recorded on the hot path is a counter increment or a histogram
+# observation (one bisect into a short list of bucket bounds). Values that
+# can be read off server state, like queue depths, are only computed when
+# somebody asks, through $$stats or the Prometheus endpoint.
+
+# Upper bounds in seconds for command handling and event loop iterations
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Upper bounds for the number of recipients of one $$send
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Slow consumers named in the $$stats summary
+LAGGARDS_SHOWN = 5
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+class Histogram:
+    """
+    Counts of observations per bucket, plus their count and sum.
+    Buckets are stored non-cumulative and summed up on export.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-th quantile, None if empty.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def prometheus(self, name, labels=''):
+        lines = []
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {seen}')
+        lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {self.count}')
+        labels = labels.rstrip(',')
+        labels = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{labels} {self.sum}')
+        lines.append(f'{name}_count{labels} {self.count}')
+        return lines
+
+
+class Metrics:
+    """
+    Counters and histograms updated by the server as it runs.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.commands = {}
+        self.fanout = Histogram(FANOUT_BUCKETS)
+        self.loop = Histogram(LATENCY_BUCKETS)
+        self.bytes_in = 0
+        self.accepts = 0
+        self.handshake_timeouts = 0
+        self.throttled = 0
+        self.dropped = 0
+        self.evicted = 0
+        # username -> slow consumer events (drops and evictions)
+        self.laggards = collections.Counter()
+
+    def command(self, name, seconds):
+        histogram = self.commands.get(name)
+        if histogram is None:
+            histogram = self.commands[name] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(seconds)
+
+    def slow_consumer(self, event, user):
+        """
+        Count a room message dropped for, or the eviction of, a slow consumer.
+        """
+        if event == 'dropped':
+            self.dropped += 1
+        else:
+            self.evicted += 1
+        self.laggards[user] += 1
+
+    def summary(self, write_stats, depths):
+        """
+        Human readable report, as sent to $$stats.
+        """
+        uptime = max(time.time() - self.started, 1e-9)
+        lines = [f'Server stats after {uptime:.0f}s:',
+                 f'Connections accepted: {self.accepts} ({self.accepts / uptime:.2f}/s), '
+                 f'{self.handshake_timeouts} timed out before sending a username',
+                 f'Bytes in: {self.bytes_in}  Bytes out: {write_stats.bytes}',
+                 f'Clients throttled by rate limits: {self.throttled}',
+                 f'Slow consumers: {self.dropped} messages dropped, {self.evicted} evicted, worst: '
+                 + (', '.join(f'{user} ({events})' for user, events in self.laggards.most_common(LAGGARDS_SHOWN)) or 'none'),
+                 f'Write coalescing: {write_stats}',
+                 f'Outbound queues: {len(depths)}, {sum(depths)} bytes queued, largest {max(depths, default=0)}',
+                 'Event loop iterations: ' + self.describe(self.loop),
+                 'Send fan-out: ' + self.describe(self.fanout, scale=1, unit=''),
+                 'Commands:']
+        for name in sorted(self.commands):
+            lines.append(f'\t{name}: ' + self.describe(self.commands[name]))
+        return '\n'.join(lines)
+
+    @staticmethod
+    def describe(histogram, scale=1000, unit='ms'):
+        if not histogram.count:
+            return 'none'
+        mean = histogram.sum / histogram.count * scale
+        p50 = histogram.quantile(0.5) * scale
+        p99 = histogram.quantile(0.99) * scale
+        return f'{histogram.count}, mean {mean:.3g}{unit}, p50 <= {p50:g}{unit}, p99 <= {p99:g}{unit}'
+
+    def prometheus(self, write_stats, depths):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        lines = ['# TYPE tinyirc_accepts_total counter',
+                 f'tinyirc_accepts_total {self.accepts}',
+                 '# TYPE tinyirc_handshake_timeouts_total counter',
+                 f'tinyirc_handshake_timeouts_total {self.handshake_timeouts}',
+                 '# TYPE tinyirc_throttled_total counter',
+                 f'tinyirc_throttled_total {self.throttled}',
+                 '# TYPE tinyirc_dropped_messages_total counter',
+                 f'tinyirc_dropped_messages_total {self.dropped}',
+                 '# TYPE tinyirc_evictions_total counter',
+                 f'tinyirc_evictions_total {self.evicted}',
+                 '# TYPE tinyirc_bytes_in_total counter',
+                 f'tinyirc_bytes_in_total {self.bytes_in}',
+                 '# TYPE tinyirc_bytes_out_total counter',
+                 f'tinyirc_bytes_out_total {write_stats.bytes}',
+                 '# TYPE tinyirc_frames_out_total counter',
+                 f'tinyirc_frames_out_total {write_stats.frames}',
+                 '# TYPE tinyirc_writes_total counter',
+                 f'tinyirc_writes_total {write_stats.writes}',
+                 '# TYPE tinyirc_outbound_queues gauge',
+                 f'tinyirc_outbound_queues {len(depths)}',
+                 '# TYPE tinyirc_outbound_queued_bytes gauge',
+                 f'tinyirc_outbound_queued_bytes {sum(depths)}',
+                 '# TYPE tinyirc_outbound_queue_max_bytes gauge',
+                 f'tinyirc_outbound_queue_max_bytes {max(depths, default=0)}',
+                 '# TYPE tinyirc_loop_iteration_seconds histogram']
+        lines += self.loop.prometheus('tinyirc_loop_iteration_seconds')
+        lines.append('# TYPE tinyirc_send_fanout histogram')
+        lines += self.fanout.prometheus('tinyirc_send_fanout')
+        lines.append('# TYPE tinyirc_command_seconds histogram')
+        for name in sorted(self.commands):
+            lines += self.commands[name].prometheus('tinyirc_command_seconds', f'command="{name}",')
+        return '\n'.join(lines) + '\n'
+
+    def http_response(self, write_stats, depths):
+        """
+        Prometheus exposition wrapped in a minimal HTTP response, so the
+        endpoint can be scraped with e.g. curl --unix-socket.
+        """
+        body = self.prometheus(write_stats, depths).encode('utf-8')
+        header = (f'HTTP/1.0 200 OK\r\nContent-Type: {PROMETHEUS_CONTENT_TYPE}\r\n'
+                  f'Content-Length: {len(body)}\r\n\r\n')
+        return header.encode('ascii') + body
@@ -0,0 +1,185 @@
+import collections
+import itertools
+import os
+import socket
+import time
+
+# Outbound buffering for the TinyIRC server.
+# Sends never block the event loop: frames are queued per connection and
+# written out at the end of the event loop iteration, all frames queued for
+# a socket during the iteration in one write. Whatever the socket doesn't
+# take is written once it becomes writable again.
+
+# Once a connection has this many unsent bytes the server stops reading
+# from it, and only resumes when the backlog has drained below LOW_WATERMARK.
+HIGH_WATERMARK = 256 * 1024
+LOW_WATERMARK = 64 * 1024
+
+# A queue holding this much is flushed right away instead of at the end of the tick
+FLUSH_THRESHOLD = 64 * 1024
+
+# Slow consumers. A client is lagging from the moment its backlog passes the
+# high watermark until it has drained below the low watermark again. Room
+# messages for a client that has lagged DROP_AFTER seconds or has
+# DROP_BACKLOG bytes unsent are dropped instead of queued, and it is told
+# how many it missed once it catches up. Past EVICT_AFTER seconds or
+# EVICT_BACKLOG bytes it is disconnected.
+DROP_AFTER = 5
+DROP_BACKLOG = 1024 * 1024
+EVICT_AFTER = 60
+EVICT_BACKLOG = 8 * 1024 * 1024
+
+# Verdicts of SlowConsumers.verdict
+KEEP, DROP, EVICT = 'keep', 'drop', 'evict'
+
+# Queued chunks are written with one sendmsg call (scatter/gather) where the
+# platform has it, up to the kernel's limit on buffers per call.
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+try:
+    IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+
+class WriteStats:
+    """
+    Counts frames queued against the write system calls it took to send them,
+    and the bytes those calls wrote.
+    """
+    def __init__(self):
+        self.frames = 0
+        self.writes = 0
+        self.bytes = 0
+
+    @property
+    def saved(self):
+        return max(self.frames - self.writes, 0)
+
+    def __str__(self):
+        return f"{self.frames} frames sent in {self.writes} writes, {self.saved} system calls saved"
+
+
+class OutboundQueue:
+    """
+    Bytes waiting to be written to one connection, oldest first.
+
+    Chunks are queued as given, never copied, so a broadcast frame can be
+    shared by the queues of every recipient. A frame may be given as a
+    tuple of chunks, e.g. a header and a view of a relayed message body.
+    """
+    def __init__(self, stats=None):
+        self.chunks = collections.deque()
+        self.size = 0
+        self.stats = stats if stats is not None else WriteStats()
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        if type(data) is tuple:
+            self.chunks.extend(data)
+            self.size += sum(map(len, data))
+        else:
+            self.chunks.append(data)
+            self.size += len(data)
+        self.stats.frames += 1
+
+    def drain(self, sock):
+        """
+        Write as much as the socket takes without blocking, gathering
+        many queued chunks into each system call.
+        A partially written chunk keeps its unsent tail at the head of the queue.
+
+        Returns the number of bytes written. Socket errors other than
+        'would block' are left to the caller.
+        """
+        written = 0
+        chunks = self.chunks
+        while chunks:
+            self.stats.writes += 1
+            try:
+                if HAVE_SENDMSG and len(chunks) > 1:
+                    sent = sock.sendmsg(list(itertools.islice(chunks, IOV_MAX)))
+                else:
+                    sent = sock.send(chunks[0])
+            except (BlockingIOError, InterruptedError):
+                break
+            written += sent
+            if self._consume(sent):
+                break
+        self.size -= written
+        self.stats.bytes += written
+        return written
+
+    def _consume(self, sent):
+        """
+        Drop sent bytes from the head of the queue.
+        Returns True when the write stopped part way through a chunk.
+        """
+        chunks = self.chunks
+        while sent:
+            chunk = chunks[0]
+            if sent < len(chunk):
+                chunks[0] = memoryview(chunk)[sent:]
+                return True
+            sent -= len(chunk)
+            chunks.popleft()
+        return False
+
+
+class SlowConsumers:
+    """
+    Lag tracking and the drop/evict policy for slow consumers.
+
+        lagging: client -> time.monotonic() when it started lagging
+        dropped: client -> room messages dropped since then
+    """
+    def __init__(self, drop_after=DROP_AFTER, drop_backlog=DROP_BACKLOG,
+                 evict_after=EVICT_AFTER, evict_backlog=EVICT_BACKLOG):
+        self.drop_after = drop_after
+        self.drop_backlog = drop_backlog
+        self.evict_after = evict_after
+        self.evict_backlog = evict_backlog
+        self.lagging = {}
+        self.dropped = {}
+
+    def start(self, client):
+        self.lagging.setdefault(client, time.monotonic())
+
+    def stop(self, client):
+        """
+        The client caught up or is gone. Returns the messages it missed.
+        """
+        self.lagging.pop(client, None)
+        return self.dropped.pop(client, 0)
+
+    def lag(self, client):
+        since = self.lagging.get(client)
+        return time.monotonic() - since if since is not None else 0
+
+    def verdict(self, client, backlog):
+        """
+        What to do with a room message for the client: KEEP, DROP or EVICT.
+        """
+        if client not in self.lagging:
+            return KEEP
+        if self.evicting(client, backlog):
+            return EVICT
+        if self.lag(client) >= self.drop_after or backlog >= self.drop_backlog:
+            self.dropped[client] = self.dropped.get(client, 0) + 1
+            return DROP
+        return KEEP
+
+    def evicting(self, client, backlog):
+        """
+        Whether a lagging client is past the limits for disconnecting it.
+        """
+        return client in self.lagging and (self.lag(client) >= self.evict_after or backlog >= self.evict_backlog)
+
+    def overdue(self):
+        """
+        Clients that have lagged too long, whether or not anything is
+        being sent to them.
+        """
+        now = time.monotonic()
+        return [client for client, since in self.lagging.items() if now - since >= self.evict_after]
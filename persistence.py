@@ -0,0 +1,178 @@
+import json
+import os
+
+from log import log
+from registry import USERS
+
+# Durable room state for the TinyIRC server.
+#
+# Every room mutation is appended to a write-ahead log as one JSON line.
+# Lines recorded during an event loop iteration are written and fsynced
+# together at the end of it (group commit), before the replies of that
+# iteration go out. Output written earlier in the iteration, like a queue
+# flushed once it is large, commits what has been recorded so far first.
+# Every SNAPSHOT_EVERY records the whole directory is written to a snapshot
+# and the log starts over.
+#
+# At startup the snapshot is read and the log replayed on top of it.
+# Replay is idempotent, so a crash between writing a snapshot and truncating
+# the log is harmless. A torn last line left by a crash mid write is cut off
+# the log before anything is appended after it.
+
+SNAPSHOT_EVERY = 10000
+
+# Mutations that change persistent state; entering and exiting rooms is
+# session state and not logged.
+LOGGED_OPS = ('create', 'delete', 'join', 'leave')
+
+
+def room_record(room):
+    return {'name': room.name,
+            'topic': room.topic,
+            'creator': USERS.name(room.creator),
+            'members': [USERS.name(uid) for uid in room.members],
+            'admins': [USERS.name(uid) for uid in (room.creator, *room.admins)]}
+
+
+class LegacyRoom:
+    """
+    Stand in for the Room class the old jsonpickle config refers to,
+    which kept everything in a room_attrbts dict.
+    """
+
+    def record(self):
+        attrbts = self.room_attrbts
+        return {'name': self.name,
+                'topic': attrbts['topic'],
+                'creator': attrbts['creator'],
+                'members': list(attrbts['members']),
+                'admins': list(attrbts['admins'])}
+
+
+class RoomStore:
+    """
+    Snapshot plus write-ahead log kept in one directory.
+
+    Server state is loaded with load(), fed with record() from a registry
+    listener, made durable with commit() and compacted with snapshot().
+    """
+    def __init__(self, path, sync=True):
+        self.path = path
+        self.snapshot_path = os.path.join(path, 'snapshot.json')
+        self.log_path = os.path.join(path, 'wal.log')
+        self.legacy_path = path[:-len('.d')] if path.endswith('.d') else None
+        self.sync = sync
+        self.pending = []
+        self.records = 0
+        self.log = None
+
+    def load(self):
+        """
+        Room records from the snapshot with the log replayed on top,
+        in creation order.
+        """
+        rooms = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                for record in json.load(f):
+                    rooms[record['name']] = record
+        elif self.legacy_path and os.path.exists(self.legacy_path):
+            rooms = self.load_legacy()
+        if os.path.exists(self.log_path):
+            end = 0
+            with open(self.log_path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn final line from a crash mid write
+                        break
+                    self.replay(rooms, entry)
+                    self.records += 1
+                    end += len(line)
+            if end < os.path.getsize(self.log_path):
+                log.warning("Cutting torn record off the end of %s", self.log_path)
+                os.truncate(self.log_path, end)
+        for record in rooms.values():
+            record['members'] = set(record['members'])
+        return list(rooms.values())
+
+    def load_legacy(self):
+        """
+        One time import of the jsonpickle config written by older servers.
+        It is snapshotted on the next compaction and can be deleted after.
+        """
+        import jsonpickle
+        log.info("Importing legacy config %s", self.legacy_path)
+        with open(self.legacy_path) as f:
+            legacy_rooms = jsonpickle.decode(json.load(f), classes={'__main__.Room': LegacyRoom})
+        self.records = SNAPSHOT_EVERY
+        return {room.name: room.record() for room in legacy_rooms}
+
+    def replay(self, rooms, entry):
+        op = entry['op']
+        name = entry['room']
+        if op == 'create':
+            rooms.setdefault(name, {'name': name, 'topic': entry['topic'], 'creator': entry['user'],
+                                    'members': [entry['user']], 'admins': [entry['user']]})
+            return
+        record = rooms.get(name)
+        if record is None:
+            return
+        if op == 'delete':
+            del rooms[name]
+        elif op == 'join' and entry['user'] not in record['members']:
+            record['members'].append(entry['user'])
+        elif op == 'leave' and entry['user'] in record['members']:
+            record['members'].remove(entry['user'])
+
+    def record(self, op, room, user):
+        """
+        Registry listener: buffer a log line until the next commit.
+        """
+        if op not in LOGGED_OPS:
+            return
+        entry = {'op': op, 'room': room.name, 'user': user}
+        if op == 'create':
+            entry['topic'] = room.topic
+        self.pending.append(json.dumps(entry, separators=(',', ':')))
+
+    def commit(self):
+        """
+        Group commit: one write and one fsync for everything recorded since
+        the last commit.
+        """
+        if not self.pending:
+            return
+        if self.log is None:
+            os.makedirs(self.path, exist_ok=True)
+            self.log = open(self.log_path, 'a')
+        self.log.write('\n'.join(self.pending) + '\n')
+        self.log.flush()
+        if self.sync:
+            os.fsync(self.log.fileno())
+        self.records += len(self.pending)
+        self.pending = []
+
+    def due(self):
+        return self.records >= SNAPSHOT_EVERY
+
+    def snapshot(self, rooms):
+        """
+        Write the whole room directory and start a new, empty log.
+        """
+        self.commit()
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump([room_record(room) for room in rooms], f, separators=(',', ':'))
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        if self.log is not None:
+            self.log.close()
+        self.log = open(self.log_path, 'w')
+        self.records = 0
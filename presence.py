@@ -0,0 +1,106 @@
+# Room presence subscriptions for $$watch.
+#
+# A client watching a room is sent who joined, left, entered or exited it.
+# Changes are collected during an event loop iteration and sent at its end
+# as one update per room, so a burst of joins costs each watcher a single
+# small frame instead of a $$list poll per change. Within an update a user
+# joining and leaving again, or entering and exiting, cancel out.
+
+# Changes watchers are told about, in the order an update lists them
+PRESENCE_OPS = ('join', 'leave', 'enter', 'exit', 'delete')
+OPPOSITE = {'join': 'leave', 'leave': 'join', 'enter': 'exit', 'exit': 'enter'}
+PAST = {'join': 'joined', 'leave': 'left', 'enter': 'entered', 'exit': 'exited', 'delete': 'deleted'}
+
+
+def describe(changes):
+    """
+    Readable text of an update, e.g. 'joined alice bob; exited carol'.
+    """
+    return '; '.join(' '.join((PAST[op], *users)) for op, users in changes)
+
+
+class Presence:
+    """
+    Presence subscriptions, fed with record() from a registry listener.
+
+        watchers: room name -> client sockets watching it
+        watching: client socket -> room names it watches
+        pending:  room name -> op -> users changed this iteration, for
+                  watched rooms only. The inner dicts are ordered sets.
+
+    wake is called when an iteration gets its first change, for event
+    loops that only end an iteration when there is output.
+    """
+    def __init__(self, wake=None):
+        self.watchers = {}
+        self.watching = {}
+        self.pending = {}
+        self.wake = wake
+
+    def watch(self, client, name):
+        self.watchers.setdefault(name, set()).add(client)
+        self.watching.setdefault(client, set()).add(name)
+
+    def unwatch(self, client, name):
+        """
+        Returns False if the client wasn't watching the room.
+        """
+        clients = self.watchers.get(name)
+        if clients is None or client not in clients:
+            return False
+        self._drop(client, name)
+        return True
+
+    def forget(self, client):
+        """
+        Drop every subscription of a client that went away.
+        """
+        for name in list(self.watching.get(client, ())):
+            self._drop(client, name)
+
+    def _drop(self, client, name):
+        clients = self.watchers[name]
+        clients.discard(client)
+        if not clients:
+            del self.watchers[name]
+        names = self.watching[client]
+        names.discard(name)
+        if not names:
+            del self.watching[client]
+
+    def record(self, op, room, user):
+        """
+        Registry listener: note a change to a watched room.
+        """
+        if op not in PRESENCE_OPS or room.name not in self.watchers:
+            return
+        if not self.pending and self.wake is not None:
+            self.wake()
+        changes = self.pending.setdefault(room.name, {})
+        if op == 'delete':
+            changes[op] = {}
+            return
+        undone = changes.get(OPPOSITE[op])
+        if undone is not None and user in undone:
+            del undone[user]
+        else:
+            changes.setdefault(op, {})[user] = None
+
+    def take(self):
+        """
+        The updates of this iteration as (room name, changes, watchers),
+        changes being (op, users) pairs. Changes that cancelled out are
+        left out. Watchers of deleted rooms are dropped.
+        """
+        pending, self.pending = self.pending, {}
+        updates = []
+        for name, changes in pending.items():
+            ordered = tuple((op, tuple(changes[op])) for op in PRESENCE_OPS
+                            if op in changes and (changes[op] or op == 'delete'))
+            clients = self.watchers.get(name)
+            if ordered and clients:
+                updates.append((name, ordered, list(clients)))
+            if 'delete' in changes:
+                for client in list(clients or ()):
+                    self._drop(client, name)
+        return updates
@@ -0,0 +1,91 @@
+import time
+
+# Per connection flood protection for the TinyIRC server.
+#
+# Every connection gets a set of token buckets: 'total' for everything it
+# sends plus one per rate class, see CommandSpec.rate_class. A command is
+# charged its cost to the 'total' bucket and to the bucket of its class.
+# Cheap commands cost 1, queries that walk the whole directory cost more.
+#
+# A client that runs out of tokens isn't disconnected, the server stops
+# reading from it until the buckets have refilled, so well behaved clients
+# keep being served in the meantime.
+
+# Rate classes commands are charged to, besides 'total'
+RATE_CLASSES = ('send', 'query', 'control')
+
+# Tokens per second and bucket size of each class
+RATE_LIMITS = {'total': (200, 1000),
+               'send': (100, 500),
+               'query': (20, 100)}
+
+
+def parse_rate_limit(text):
+    """
+    'CLASS=RATE[/BURST]' from the command line, e.g. 'query=5/20'.
+    The burst defaults to one second's worth, a rate of 0 disables the bucket.
+    """
+    name, _, spec = text.partition('=')
+    if name != 'total' and name not in RATE_CLASSES:
+        raise ValueError(f"Unknown rate class {name!r}, pick one of total, {', '.join(RATE_CLASSES)}")
+    rate, _, burst = spec.partition('/')
+    try:
+        rate = float(rate)
+        burst = float(burst) if burst else max(rate, 1)
+    except ValueError:
+        raise ValueError(f"Rate limits look like CLASS=RATE[/BURST], not {text!r}")
+    return name, (rate, burst)
+
+
+class TokenBucket:
+    """
+    burst tokens, refilled at rate tokens per second.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def wait(self, cost, now):
+        """
+        Seconds until cost tokens are available, 0 if they are now.
+        Costs above the burst size are capped so they can pass at all.
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        missing = min(cost, self.burst) - self.tokens
+        return missing / self.rate if missing > 0 else 0
+
+    def take(self, cost):
+        self.tokens -= min(cost, self.burst)
+
+
+class RateLimiter:
+    """
+    The buckets of one connection, limits maps class name to (rate, burst).
+    """
+    __slots__ = ('buckets',)
+
+    def __init__(self, limits):
+        now = time.monotonic()
+        self.buckets = {name: TokenBucket(rate, burst, now)
+                        for name, (rate, burst) in limits.items() if rate > 0}
+
+    def take(self, rate_class, cost):
+        """
+        Charge a command if every bucket involved can pay for it.
+        Returns 0 if it may run now, or the seconds to wait before retrying,
+        in which case nothing is charged.
+        """
+        buckets = [bucket for bucket in (self.buckets.get('total'), self.buckets.get(rate_class))
+                   if bucket is not None]
+        now = time.monotonic()
+        wait = max([bucket.wait(cost, now) for bucket in buckets], default=0)
+        if wait:
+            return wait
+        for bucket in buckets:
+            bucket.take(cost)
+        return 0
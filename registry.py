@@ -0,0 +1,248 @@
+import sys
+
+# Indexed server state for TinyIRC.
+# Every lookup a command needs is a dict or set access, so handlers run in
+# O(1) or O(size of the answer) no matter how many rooms or users exist.
+#
+# Users are interned: each name seen gets a small int id from USERS, and
+# rooms and indexes hold ids instead of name strings. The registry gives an
+# id back once nothing refers to it, so names that only ever connected, like
+# those of a client trying random names, don't pile up.
+
+
+class UserTable:
+    """
+    Interned user names. Ids index a list. A released id is handed out
+    again to the next new name, so it must not be referred to anywhere.
+    """
+    __slots__ = ('ids', 'names', 'free')
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        self.free = []
+
+    def id(self, name):
+        uid = self.ids.get(name)
+        if uid is None:
+            name = sys.intern(name)
+            if self.free:
+                uid = self.free.pop()
+                self.names[uid] = name
+            else:
+                uid = len(self.names)
+                self.names.append(name)
+            self.ids[name] = uid
+        return uid
+
+    def release(self, uid):
+        del self.ids[self.names[uid]]
+        self.names[uid] = None
+        self.free.append(uid)
+
+    def find(self, name):
+        """
+        Id of a name, or None if it was never interned.
+        """
+        return self.ids.get(name)
+
+    def name(self, uid):
+        return self.names[uid]
+
+
+USERS = UserTable()
+
+# Shared active or online set of every room nobody is in, replaced on the
+# first user added
+NOBODY = frozenset()
+
+
+class Registry:
+    """
+    Rooms, connected users and the indexes between them.
+
+        rooms:       room name -> Room
+        users:       user id -> client socket of their connection
+        memberships: user id -> room names the user has joined
+        active:      user id -> room names the user has entered
+        sessions:    user id -> number of connections under that name,
+                     users only holds the newest
+        owners:      user id -> number of rooms created or administered
+
+    The per user indexes are dicts used as insertion ordered sets.
+
+    The Room objects stay the source of truth for their own members/active
+    sets; the registry keeps the reverse indexes in step with them, and
+    each room's online set: the members that are connected, which is who
+    a message to the room goes to.
+    All mutations must go through these methods.
+
+    Callables in self.listeners are called as listener(op, room, user) after
+    every room mutation, op being one of create, delete, join, leave, enter
+    or exit and user a name. Rooms indexed by load are not announced.
+
+    A user id that none of the indexes refer to any more is released
+    from USERS.
+    """
+    def __init__(self):
+        self.rooms = {}
+        self.users = {}
+        self.memberships = {}
+        self.active = {}
+        self.sessions = {}
+        self.owners = {}
+        self.listeners = []
+
+    def load(self, rooms):
+        """
+        Index a list of Room objects, e.g. from a saved config.
+        """
+        for room in rooms:
+            self._index_room(room)
+
+    def room_list(self):
+        return list(self.rooms.values())
+
+    def get(self, name):
+        return self.rooms.get(name)
+
+    # Rooms
+    def add_room(self, room):
+        self._index_room(room)
+        self._notify('create', room, room.creator)
+
+    def _index_room(self, room):
+        self.rooms[room.name] = room
+        for uid in (room.creator, *room.admins):
+            self.owners[uid] = self.owners.get(uid, 0) + 1
+        for uid in room.members:
+            self.memberships.setdefault(uid, {})[room.name] = None
+            if uid in self.users:
+                self._online(room, uid)
+        for uid in room.active:
+            self.active.setdefault(uid, {})[room.name] = None
+
+    def delete_room(self, name):
+        room = self.rooms.pop(name)
+        for uid in room.members:
+            self._unindex(self.memberships, uid, name)
+        for uid in room.active:
+            self._unindex(self.active, uid, name)
+        for uid in (room.creator, *room.admins):
+            self._unref(self.owners, uid)
+        self._notify('delete', room, None)
+        for uid in {room.creator, *room.admins, *room.members, *room.active}:
+            self._release(uid)
+        return room
+
+    # Membership
+    def join(self, room, uid):
+        room.members.add(uid)
+        self.memberships.setdefault(uid, {})[room.name] = None
+        if uid in self.users:
+            self._online(room, uid)
+        self._notify('join', room, uid)
+
+    def leave(self, room, uid):
+        room.members.remove(uid)
+        self._unindex(self.memberships, uid, room.name)
+        self._offline(room, uid)
+        self._notify('leave', room, uid)
+        self._release(uid)
+
+    def rooms_of(self, uid):
+        """
+        Rooms the user has joined, in the order they joined them.
+        """
+        return [self.rooms[name] for name in self.memberships.get(uid, ())]
+
+    # Active sessions
+    def enter(self, room, uid):
+        if room.active is NOBODY:
+            room.active = set()
+        room.active.add(uid)
+        self.active.setdefault(uid, {})[room.name] = None
+        self._notify('enter', room, uid)
+
+    def exit(self, room, uid):
+        if uid in room.active:
+            room.active.remove(uid)
+            if not room.active:
+                room.active = NOBODY
+        self._unindex(self.active, uid, room.name)
+        self._notify('exit', room, uid)
+        self._release(uid)
+
+    def active_room(self, uid):
+        """
+        A room the user is currently active in, or None.
+        """
+        names = self.active.get(uid)
+        if not names:
+            return None
+        return self.rooms[next(iter(names))]
+
+    def clear_active(self):
+        for room in self.rooms.values():
+            room.active = NOBODY
+        self.active.clear()
+
+    # Connections
+    def connect(self, uid, client_socket):
+        self.sessions[uid] = self.sessions.get(uid, 0) + 1
+        if uid not in self.users:
+            for name in self.memberships.get(uid, ()):
+                self._online(self.rooms[name], uid)
+        self.users[uid] = client_socket
+
+    def disconnect(self, uid, client_socket):
+        """
+        Forget a user's connection, and the rooms they were active in.
+        A newer connection under the same name is left alone.
+        """
+        if self.users.get(uid) is client_socket:
+            del self.users[uid]
+            for name in self.memberships.get(uid, ()):
+                self._offline(self.rooms[name], uid)
+            for name in list(self.active.get(uid, ())):
+                self.exit(self.rooms[name], uid)
+        self._unref(self.sessions, uid)
+        self._release(uid)
+
+    @staticmethod
+    def _online(room, uid):
+        if room.online is NOBODY:
+            room.online = set()
+        room.online.add(uid)
+
+    @staticmethod
+    def _offline(room, uid):
+        if uid in room.online:
+            room.online.remove(uid)
+            if not room.online:
+                room.online = NOBODY
+
+    def _notify(self, op, room, uid):
+        user = USERS.name(uid) if uid is not None else None
+        for listener in self.listeners:
+            listener(op, room, user)
+
+    def _release(self, uid):
+        if (uid not in self.sessions and uid not in self.memberships and uid not in self.owners
+                and uid not in self.active):
+            USERS.release(uid)
+
+    @staticmethod
+    def _unref(counts, uid):
+        count = counts.get(uid, 0) - 1
+        if count > 0:
+            counts[uid] = count
+        else:
+            counts.pop(uid, None)
+
+    def _unindex(self, index, uid, name):
+        names = index.get(uid)
+        if names is not None:
+            names.pop(name, None)
+            if not names:
+                del index[uid]
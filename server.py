@@ -3,30 +3,103 @@ import select
 import signal
 import sys
 import os
-import json
-import jsonpickle
+import argparse
+import itertools
+import importlib
+import time
 import pprint
+from framing import FramingError, RECV_CHUNK, LEGACY, codec_for, encode_frame, split_frame
+from commands import CommandError, parse_command, parse_send
+from outbound import (OutboundQueue, SlowConsumers, WriteStats, HIGH_WATERMARK, LOW_WATERMARK, FLUSH_THRESHOLD,
+                      DROP, EVICT)
+from registry import Registry, USERS, NOBODY
+from persistence import RoomStore, room_record
+from history import History, HISTORY_DEFAULT, HISTORY_MAX
+from directory import Directory, LIST_MAX, LIST_PAGE, frames
+from presence import Presence
+from log import log, setup_logging, LEVELS
+from metrics import Metrics
+from ratelimit import RATE_LIMITS, RateLimiter, parse_rate_limit
 
-HEADER_LENGTH = 10
 IP = "127.0.0.1"
 LISTENING_PORT = 9001
+LISTEN_BACKLOG = socket.SOMAXCONN
+
+# Longest the loop sleeps while a client is lagging, so it is evicted in time
+CONSUMER_CHECK = 1.0
+
+# Seconds a new connection has to send its username frame, and the most
+# it may send before that
+HANDSHAKE_TIMEOUT = 10
+HANDSHAKE_MAX_BYTES = 4096
+# Connections accepted per wakeup at most, so a reconnect storm can't
+# keep the loop from serving the clients already connected
+ACCEPT_BATCH = 256
+
+# Optional protocol features a client may ask for in its username frame
+CAPABILITIES = ('v2', 'zlib')
 
 class Room:
     """
     Core abstraction of this program. Connecting clients want to
     exchange messages with each other in rooms.
+
+    Users are held as ids from the USERS table. Nobody is active in most
+    rooms and the creator is usually the only admin, so active and the set
+    of other admins share the empty NOBODY set until they are needed.
+    online, the members that are connected, is kept by the Registry and
+    shares NOBODY too while none are.
     """
+    __slots__ = ('name', 'topic', 'creator', 'members', 'active', 'admins', 'online')
+
     def __init__(self, creator, name='Linux', topic='Default'):
+        creator = USERS.id(creator)
+        self.name = name
+        self.topic = topic
+        self.creator = creator
+        self.members = {creator}
+        self.active = NOBODY
+        self.admins = NOBODY
+        self.online = NOBODY
+
+    def is_admin(self, uid):
+        return uid == self.creator or uid in self.admins
+
+
+class Session:
+    """
+    A connected user, the value of Server.clients.
+    limiter is None for connections that aren't rate limited.
+    """
+    __slots__ = ('name', 'uid', 'limiter')
+
+    def __init__(self, name, limiter=None):
         self.name = name
+        self.uid = USERS.id(name)
+        self.limiter = limiter
+
+    def __repr__(self):
+        return f"Session({self.name!r})"
+
+class Handshake:
+    """
+    A connection that hasn't sent its username frame yet, the value of
+    Server.handshaking.
+    """
+    __slots__ = ('deadline', 'buffer')
 
-        self.room_attrbts = {'topic' : topic, 
-                        'creator': creator,
-                        'members': { creator },
-                        'active': set(),
-                        'admins': [creator]}
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.buffer = bytearray()
 
 class Server:
-    def __init__(self):
+    # Set by servers that share the listening port with sibling processes
+    reuse_port = False
+    # Whether this server records room changes to the store
+    persist = True
+
+    def __init__(self, high_watermark=HIGH_WATERMARK, low_watermark=LOW_WATERMARK, admins=(), rate_limits=RATE_LIMITS,
+                 port=LISTENING_PORT):
         """
         TinyIRC chat server that asynchronosly handles client connections
         and manages a list of Room objects based on user commands.
@@ -37,55 +110,110 @@ class Server:
                         echoing information back to a client,
                         changing the state of the room list and echoing success to client.
 
+        Outgoing messages are queued per socket and written at the end of each
+        event loop iteration, or when the socket is writable again if it
+        couldn't take everything. A client with more than high_watermark
+        bytes unsent is not read from until its backlog drops below low_watermark.
+
+        Clients connect to port on IP. A new connection is read from like
+        any other until its username frame has arrived, and is dropped if
+        that takes longer than HANDSHAKE_TIMEOUT.
+
+        Each connection is rate limited as set by rate_limits, see ratelimit.py.
+        A client over its limits is not read from until it is back under them.
+
+        Clients that stay backed up have room messages dropped and are
+        eventually disconnected, see SlowConsumers.
         """
         self.pp = pprint.PrettyPrinter(indent=4)
-        self.rooms = []
+        self.registry = Registry()
         self.clients = {}
+        self.handshaking = {}
+        self.decoders = {}
+        self.codecs = {}
+        self.outbound = {}
+        self.write_stats = WriteStats()
+        self.pending_writes = set()
+        self.blocked_writes = set()
+        self.paused = set()
+        self.deferred = {}
+        self.throttled = {}
+        self.consumers = SlowConsumers()
+        self.rate_limits = rate_limits
+        self.high_watermark = high_watermark
+        self.admins = set(admins)
+        self.metrics = Metrics()
+        self.metrics_socket = None
+        self.scrapes = set()
+        self.low_watermark = low_watermark
         self.name_list = []
-        self.server_listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_listen_socket.bind((IP, LISTENING_PORT))
-        self.server_listen_socket.listen()
+        self.port = port
+        self.server_listen_socket = self.create_listen_socket()
         self.sockets_list = [self.server_listen_socket]
+        self.store = RoomStore(self.store_path())
+        self.load_config()
+        if self.persist:
+            self.registry.listeners.append(self.store.record)
+            if self.store.due():
+                self.store.snapshot(self.registry.room_list())
+        self.history = History(self.history_path())
+        self.registry.listeners.append(self.history.record)
+        self.directory = Directory(self.registry)
+        self.registry.listeners.append(self.directory.record)
+        self.presence = Presence(self.schedule_tick)
+        self.registry.listeners.append(self.presence.record)
+
+    def store_path(self):
+        return os.environ.get('HOME') + '/.tinyserver.d'
+
+    def history_path(self):
+        return os.path.join(self.store.path, 'history')
+
+    def load_config(self):
+        """
+        Rooms are always loaded from the store on startup: the last
+        snapshot with the write-ahead log replayed on top.
+        Delete ~/.tinyserver.d to start clean.
+        """
+        try:
+            rooms = []
+            for record in self.store.load():
+                room = Room(creator=record['creator'], name=record['name'], topic=record['topic'])
+                room.members = {USERS.id(user) for user in record['members']}
+                room.admins = frozenset(USERS.id(user) for user in record['admins']) - {room.creator} or NOBODY
+                rooms.append(room)
+            self.registry.load(rooms)
+            log.info('Rooms config loaded, %d rooms...', len(rooms))
 
-        def load_config(self):
-            """
-            If a config file exists, load it always on server.
-            Must manually delete config to start clean or 
-            load, make changes and re-save for changes.
-            """
-            try:
-                path = os.environ.get('HOME') + '/.tinyserver'
-                if os.path.exists(path):
-                    with open(path) as f:
-                        JSON = json.load(f)
-                        self.rooms = jsonpickle.decode(JSON)
-                print('Rooms config loaded...')
-                
-            except Exception as e:
-                print("Error while loading server config {0}".format(e))
-
-        load_config(self)
+        except Exception as e:
+            log.error("Error while loading server config %s", e)
+
+    def create_listen_socket(self):
+        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listen_socket.bind((IP, self.port))
+        listen_socket.listen(LISTEN_BACKLOG)
+        listen_socket.setblocking(False)
+        return listen_socket
 
     def save_config(self):
         """
-        Save server room state as a json file and print it.
+        Print server room state and save a snapshot of it.
+        Room changes are logged as they happen, so this only compacts the log.
         """
         try:
             print("Clearing active users")
-            for room in self.rooms:
-                room.room_attrbts['active'].clear()
+            self.registry.clear_active()
             print('Saving config...')
             print("Known clients:")
             self.pp.pprint(self.clients)
             print("Known rooms:")
-            for room in self.rooms: 
-                self.pp.pprint(room.name)
-                self.pp.pprint(room.room_attrbts)
-            path = os.environ.get('HOME') + '/.tinyserver'
-            roomJSON = jsonpickle.encode(self.rooms)
-            with open(path, 'w') as f:
-                json.dump(roomJSON, f)
+            for room in self.registry.room_list():
+                self.pp.pprint(room_record(room))
+            self.store.snapshot(self.registry.room_list())
+            self.history.flush()
         except Exception as e:
             print("Error saving config!! {0}".format(e))
 
@@ -96,6 +224,7 @@ class Server:
         Additionally, can continue server operator or shutdown.
         """
         print('You pressed Ctrl+C!')
+        print(f"Write coalescing: {self.write_stats}")
         response = input("Would you like to terminate a user session? [y/n] ")
         if response.lower() == 'exit':
             print("fast exiting..")
@@ -108,19 +237,20 @@ class Server:
                 print("Choose a user to remove:\n")
                 user_list = []
                 for client in self.clients:
-                    user_list.append(self.clients[client]['data'].decode('utf-8'))
+                    user_list.append(self.clients[client].name)
                 for user in user_list: print(user)
                 response = input("Enter user to remove: ")
-                for client in self.clients:
-                    if self.clients[client]['data'].decode('utf-8') == response:
-                        msg = f"Booting client {self.clients[client]} from server..."
-                        self.log_and_send(client, msg)
-                        print("Closing socket...")
-                        self.sockets_list.remove(client)
-                        del self.clients[client]
-                        client.shutdown(socket.SHUT_RDWR)
-                        print(f"Client {response} booted. Returning to listening...")
-                        return
+                client = self.registry.users.get(USERS.find(response))
+                # Users of linked servers can't be booted from here
+                if client in self.clients:
+                    msg = f"Booting client {self.clients[client].name} from server..."
+                    self.log_and_send(client, msg)
+                    self.flush_client(client)
+                    print("Closing socket...")
+                    client.shutdown(socket.SHUT_RDWR)
+                    self.close_client(client)
+                    print(f"Client {response} booted. Returning to listening...")
+                    return
                 trying = input("No matching client found. Try again? [y/n] ")
 
         response = input("Save config? [y/n] ")
@@ -138,92 +268,448 @@ class Server:
             sys.exit(0)
 
 
+    def close_client(self, client_socket):
+        """
+        Forget a client connection and release its socket.
+        Every disconnect path (quit, error, boot) ends up here.
+        """
+        if client_socket in self.sockets_list:
+            self.sockets_list.remove(client_socket)
+        user = self.clients.pop(client_socket, None)
+        if user is not None:
+            self.registry.disconnect(user.uid, client_socket)
+        self.handshaking.pop(client_socket, None)
+        self.decoders.pop(client_socket, None)
+        self.codecs.pop(client_socket, None)
+        self.outbound.pop(client_socket, None)
+        self.pending_writes.discard(client_socket)
+        self.blocked_writes.discard(client_socket)
+        self.paused.discard(client_socket)
+        self.deferred.pop(client_socket, None)
+        self.throttled.pop(client_socket, None)
+        self.consumers.stop(client_socket)
+        self.presence.forget(client_socket)
+        client_socket.close()
+
+
     def handle_exceptions(self, exception_sockets):
         """
         For now if a client socket has errored, simply drop it
         """
         for notified_socket in exception_sockets:
-            print("Dropping socket {0} due to exception".format(repr(notified_socket)))
-            self.sockets_list.remove(notified_socket)
-            del self.clients[notified_socket]
+            log.warning("Dropping socket %r due to exception", notified_socket)
+            self.close_client(notified_socket)
 
 
-    def receive_message(self, client_socket):
+    def receive_messages(self, client_socket):
         """
-        Receive a message from a client socket
-        First interprets the header of 10 bytes,
-        which is telling the server the length of the following message
+        Read one large chunk from a client socket and return every
+        complete message it finished, possibly none.
+        Returns False once the client has gone away.
         """
         try:
-            message_header = client_socket.recv(HEADER_LENGTH)
-
-            if not len(message_header):
+            data = client_socket.recv(RECV_CHUNK)
+            if not data:
                 return False
+            self.metrics.bytes_in += len(data)
+            return self.decoders[client_socket].feed(data)
+        except (OSError, FramingError) as e:
+            log.warning("Failed to receive message: %s", e)
+            return False
 
-            message_length = int(message_header.decode("utf-8").strip())
-            return {"header": message_header, "data":client_socket.recv(message_length)}
 
-        except:
-            return False
+    def queue_send(self, client_socket, data):
+        """
+        Queue framed bytes for a client. Never blocks: the queue is flushed
+        at the end of the event loop iteration, or as soon as it holds
+        FLUSH_THRESHOLD bytes.
+
+        Reading from a client is paused while its backlog is above the high watermark.
+        """
+        queue = self.outbound[client_socket]
+        queue.append(data)
+        if client_socket not in self.blocked_writes:
+            self.pending_writes.add(client_socket)
+            if len(queue) >= FLUSH_THRESHOLD:
+                self.handle_writes([client_socket])
+                if client_socket not in self.outbound:
+                    return
+        if len(queue) > self.high_watermark and client_socket not in self.paused:
+            log.info("Outbound backlog of %d bytes, pausing reads from %s", len(queue), self.clients[client_socket].name)
+            self.paused.add(client_socket)
+            self.consumers.start(client_socket)
+
+
+    def flush_client(self, client_socket):
+        """
+        Best effort write of whatever is queued for a client, used before closing it.
+        """
+        self.store.commit()
+        try:
+            self.outbound[client_socket].drain(client_socket)
+        except OSError:
+            pass
 
 
     def just_send(self, client_socket, msg):
         """
         Send 10 utf-8 bytes as a header representing length of following message in utf-8 bytes.
+        v2 clients get the message as a reply frame instead.
         """
-        msg = msg.encode('utf-8')
-        message_header = f"{len(msg):<{HEADER_LENGTH}}".encode('utf-8')
-        client_socket.send(message_header + msg)
+        self.queue_send(client_socket, self.codecs.get(client_socket, LEGACY).reply(msg))
         return
 
 
+    def end_replies(self, client_socket):
+        """
+        Tell a v2 client that the command it sent has been fully handled.
+        """
+        done = self.codecs.get(client_socket, LEGACY).done()
+        if done is not None:
+            self.queue_send(client_socket, done)
+
+
+    def broadcast(self, client_sockets, roomname, sending_user, body):
+        """
+        Send the same chat message to many clients.
+        The frame is encoded once per protocol version and that one bytes
+        object is queued for every recipient speaking it.
+        Lagging recipients may have it dropped instead, see keep_up.
+        Returns the number of recipients it was queued for.
+        """
+        return self.fan_out(client_sockets, lambda codec: codec.message(roomname, sending_user, body))
+
+    def fan_out(self, client_sockets, encode):
+        """
+        Queue the frame encode(codec) returns for many clients, encoding it
+        once per codec. Lagging recipients go through keep_up.
+        """
+        frames = {}
+        count = 0
+        lagging = self.consumers.lagging
+        for client_socket in client_sockets:
+            if client_socket in lagging and not self.keep_up(client_socket):
+                continue
+            codec = self.codecs.get(client_socket, LEGACY)
+            frame = frames.get(codec)
+            if frame is None:
+                frame = frames[codec] = encode(codec)
+            self.queue_send(client_socket, frame)
+            count += 1
+        return count
+
+
+    def keep_up(self, client_socket):
+        """
+        Slow consumer policy for a lagging client about to be sent a room
+        message. Returns False if the message is dropped or the client
+        evicted instead.
+        """
+        verdict = self.consumers.verdict(client_socket, self.backlog(client_socket))
+        if verdict == DROP:
+            self.metrics.slow_consumer('dropped', self.clients[client_socket].name)
+            return False
+        if verdict == EVICT:
+            self.evict(client_socket)
+            return False
+        return True
+
+    def evict(self, client_socket):
+        """
+        Disconnect a slow consumer, the same way as a socket in error.
+        """
+        user = self.clients[client_socket].name
+        log.warning("Evicting slow consumer %s: %d bytes unsent, lagging for %.1fs",
+                    user, self.backlog(client_socket), self.consumers.lag(client_socket))
+        self.metrics.slow_consumer('evicted', user)
+        self.close_client(client_socket)
+
+    def caught_up(self, client_socket):
+        """
+        A lagging client drained its backlog, tell it what it missed.
+        """
+        dropped = self.consumers.stop(client_socket)
+        if dropped:
+            log.info("%s caught up after %d room messages were dropped", self.clients[client_socket].name, dropped)
+            self.just_send(client_socket, f"You fell behind, {dropped} room messages were not delivered to you.")
+
+    def check_consumers(self):
+        for client_socket in self.consumers.overdue():
+            self.evict(client_socket)
+
+    def backlog(self, client_socket):
+        """
+        Bytes queued for a client that it hasn't taken yet.
+        """
+        queue = self.outbound.get(client_socket)
+        return len(queue) if queue is not None else 0
+
     def log_and_send(self, client_socket, msg):
-        print(msg)
+        log.debug(msg)
         self.just_send(client_socket, msg)
     
 
     def handle_new_conn(self):
         """
-        Upon receiving a new connection on Port 9001 accept and allocate a new connection socket.
+        Upon new connections on the listening port, accept every one that is
+        waiting, up to ACCEPT_BATCH.
+
+        Nothing is read from them here. They wait in self.handshaking for
+        their username frame, see continue_handshake.
+        """
+        deadline = time.monotonic() + HANDSHAKE_TIMEOUT
+        for _ in range(ACCEPT_BATCH):
+            try:
+                client_socket, address = self.server_listen_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                log.warning("Failed to accept connection: %s", e)
+                break
+            self.metrics.accepts += 1
+            log.info("Accepted new connection from %s:%s", address[0], address[1])
+            client_socket.setblocking(False)
+            self.handshaking[client_socket] = Handshake(deadline)
+            self.sockets_list.append(client_socket)
+
+    def continue_handshake(self, client_socket):
+        """
+        Read from a connection that hasn't sent its username frame yet,
+        and set it up once the frame is complete. Commands pipelined
+        behind the username are handled right away.
+        """
+        state = self.handshaking[client_socket]
+        try:
+            data = client_socket.recv(RECV_CHUNK)
+            if data:
+                self.metrics.bytes_in += len(data)
+                state.buffer += data
+                split = split_frame(state.buffer, HANDSHAKE_MAX_BYTES)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (OSError, FramingError) as e:
+            log.warning("Failed to receive username: %s", e)
+            data = None
+        if not data or (split is None and len(state.buffer) > HANDSHAKE_MAX_BYTES):
+            self.close_client(client_socket)
+            return
+        if split is None:
+            return
+        message, rest = split
+        del self.handshaking[client_socket]
+        if not self.finish_handshake(client_socket, message):
+            self.close_client(client_socket)
+            return
+        if rest:
+            try:
+                messages = self.decoders[client_socket].feed(rest)
+            except FramingError as e:
+                log.warning("Failed to receive message: %s", e)
+                self.close_client(client_socket)
+                return
+            self.handle_messages(client_socket, messages)
 
-        Make sure the message was parsed correctly, then add the new private socket to server state.
+    def finish_handshake(self, client_socket, message):
+        """
+        Set up the session of a connection from its username frame.
+        Returns False if the connection is refused.
         """
-        self.latest_client_socket, self.latest_client_address = self.server_listen_socket.accept()
-        print("Accepted new connection from {0}:{1}".format(self.latest_client_address[0], self.latest_client_address[1]))
-        user = self.receive_message(self.latest_client_socket)
+        self.outbound[client_socket] = OutboundQueue(self.write_stats)
+        user = self.handshake(client_socket, message)
         if user is False:
             return False
-
-        self.sockets_list.append(self.latest_client_socket)
-        self.clients[self.latest_client_socket] = user
-        print("Accepted new user: {0}".format(user['data'].decode('utf-8')))
+        self.clients[client_socket] = user
+        self.decoders[client_socket] = self.codecs[client_socket].decoder()
+        self.registry.connect(user.uid, client_socket)
+        log.info("Accepted new user: %s", user.name)
         return True
 
-    
+    def expire_handshakes(self):
+        """
+        Drop connections that haven't sent their username in time.
+        Returns the seconds until the next deadline, or None.
+
+        Deadlines are handed out in order, so the oldest handshake is first.
+        """
+        now = time.monotonic()
+        while self.handshaking:
+            client_socket, state = next(iter(self.handshaking.items()))
+            if state.deadline > now:
+                return state.deadline - now
+            log.info("Dropping connection that sent no username within %ds", HANDSHAKE_TIMEOUT)
+            self.metrics.handshake_timeouts += 1
+            self.close_client(client_socket)
+        return None
+
+    def handshake(self, client_socket, user):
+        """
+        The username frame is the name, optionally followed by the
+        capabilities the client would like, e.g. 'alice v2 zlib'.
+
+        Pick the codec for the connection and ack the capabilities we
+        accept with a legacy framed '$$caps ...' message, after which the
+        client switches over. Clients that ask for nothing get no ack.
+        Returns the user's Session, or False for an empty name or one that
+        is taken, which the client is told about before being dropped.
+        """
+        words = user['data'].decode('utf-8', 'replace').split()
+        if not words:
+            return False
+        reason = self.name_taken(words[0])
+        if reason is not None:
+            log.warning("Refusing connection: %s", reason)
+            self.queue_send(client_socket, encode_frame(reason.encode('utf-8')))
+            self.flush_client(client_socket)
+            return False
+        caps = [cap for cap in words[1:] if cap in CAPABILITIES]
+        if caps:
+            self.queue_send(client_socket, encode_frame(("$$caps " + " ".join(caps)).encode('utf-8')))
+        self.codecs[client_socket] = codec_for(caps)
+        return Session(words[0], RateLimiter(self.rate_limits) if self.rate_limits else None)
+
+
+    def name_taken(self, name):
+        """
+        Why a name can't be used for a new connection, or None.
+        """
+        return None
+
+
     def handle_existing_conn(self, notified_socket):
         """
         Upon receiving a message from any port that is not 9001,
-        validate that the user did not quit. Afterwards receive the message,
-        and send to the parent handler, which will route to appropriate
+        validate that the user did not quit. Afterwards receive the messages,
+        and send each to the parent handler, which will route to appropriate
         command handler.
+
+        A single read may carry several pipelined messages, they are all
+        handled in this wakeup.
         """
 
-        message = self.receive_message(notified_socket)
-        print(f"We received message {message}")
+        messages = self.receive_messages(notified_socket)
 
         # User quits
-        if message is False:
-            print("Closed connection from {0}".format(self.clients[notified_socket]['data'].decode('utf-8')))
-            self.sockets_list.remove(notified_socket)
-            del self.clients[notified_socket]
+        if messages is False:
+            log.info("Closed connection from %s", self.clients[notified_socket].name)
+            self.close_client(notified_socket)
             return False
         
+        self.handle_messages(notified_socket, messages)
+        return True
+
+
+    def handle_messages(self, notified_socket, messages):
+        """
+        Run the commands a client sent, in order.
+
+        If the replies back the client up past the high watermark, the rest
+        of its messages wait in self.deferred until its backlog has drained.
+        The same goes for a client over its rate limits, until the time in
+        self.throttled when it has tokens again.
+        """
         # User's socket sent us something in lobby
         user = self.clients[notified_socket]
-        print("Received message from {0}: {1}".format(user['data'].decode('utf-8'), message['data'].decode('utf-8')))
-        print("Interpreting... {0}".format(message['data']))
-        self.handle_lobby_command(message['data'], notified_socket)
-        return True
+        for i, message in enumerate(messages):
+            if self.holding(notified_socket):
+                self.deferred[notified_socket] = messages[i:]
+                return
+            wait = self.rate_wait(notified_socket, message)
+            if wait:
+                self.throttled[notified_socket] = time.monotonic() + wait
+                self.deferred[notified_socket] = messages[i:]
+                return
+            log.debug("Received message from %s: %r", user.name, message.get('data') or message.get('command'))
+            self.run_command(notified_socket, message)
+
+
+    def holding(self, client_socket):
+        """
+        Whether a client's messages have to wait in self.deferred
+        instead of being run, and it isn't read from meanwhile.
+        """
+        return client_socket in self.paused or client_socket in self.throttled
+
+    def read_list(self):
+        """
+        Sockets for select to watch for reading: all but held clients.
+        """
+        if not self.paused and not self.throttled:
+            return self.sockets_list
+        return [s for s in self.sockets_list if not self.holding(s)]
+
+    def parse(self, message):
+        """
+        The Command of a received message, parsed once and kept on the message.
+        v2 frames arrive already parsed by their decoder. A $$send only has
+        its room name decoded, see parse_send.
+        """
+        command = message.get('command')
+        if command is None:
+            data = message['data']
+            command = parse_send(data) or parse_command(data.decode('utf-8'))
+            message['command'] = command
+        return command
+
+    def rate_wait(self, client_socket, message):
+        """
+        Charge a message to its sender's rate limits. Returns 0 if it can
+        run now, otherwise the seconds until the sender has the tokens for it.
+        Frames that don't parse are charged like a cheap command.
+        """
+        session = self.clients.get(client_socket)
+        if session is None or session.limiter is None:
+            return 0
+        try:
+            spec = self.parse(message).spec
+            wait = session.limiter.take(spec.rate_class, spec.cost)
+        except (CommandError, UnicodeDecodeError):
+            wait = session.limiter.take(None, 1)
+        if wait:
+            self.metrics.throttled += 1
+            log.debug("User %s is over their rate limits, not reading for %.3fs", session.name, wait)
+        return wait
+
+    def release_throttled(self):
+        """
+        Go back to reading from throttled clients whose time is up,
+        starting with the messages they had sent meanwhile.
+        """
+        now = time.monotonic()
+        for client_socket, until in list(self.throttled.items()):
+            if until <= now:
+                del self.throttled[client_socket]
+                deferred = self.deferred.pop(client_socket, None)
+                if deferred:
+                    self.handle_messages(client_socket, deferred)
+
+    def throttle_due(self):
+        """
+        Seconds until the next throttled client is due, or None.
+        Asked once the iteration is over, since clients can be throttled
+        up to its very end, by deferred commands run when their output drains.
+        """
+        if not self.throttled:
+            return None
+        return max(min(self.throttled.values()) - time.monotonic(), 0)
+
+    def run_command(self, client_socket, message):
+        """
+        Handle one command and mark the end of its replies.
+        """
+        started = time.perf_counter()
+        name = 'other'
+        try:
+            command = self.parse(message)
+            name = command.name
+            self.handle_lobby_command(command, client_socket)
+        except (CommandError, UnicodeDecodeError) as e:
+            log.debug("Rejected command %r: %s", message.get('data') or message.get('command'), e)
+            self.log_and_send(client_socket, str(e))
+        except Exception as e:
+            log.error("Error handling message from socket %s", e)
+        # Anything unknown is lumped together so clients can't create new series
+        self.metrics.command(name, time.perf_counter() - started)
+        self.end_replies(client_socket)
 
 
     def handle_conns(self, read_sockets):
@@ -233,80 +719,139 @@ class Server:
         Otherwise, it's one of our existing users!
         """
         for notified_socket in read_sockets:
-            print("Checking sockets...")
             if notified_socket == self.server_listen_socket:
-                if not self.handle_new_conn():
-                    continue
-            
+                self.handle_new_conn()
+            elif notified_socket in self.handshaking:
+                self.continue_handshake(notified_socket)
+            elif notified_socket is self.metrics_socket:
+                self.accept_scrape()
+            elif notified_socket in self.scrapes:
+                self.answer_scrape(notified_socket)
             else:
                 try:
                     if not self.handle_existing_conn(notified_socket):
                         continue
                 except Exception as e:
-                    print(f"Error handling message from socket {e}")
+                    log.error("Error handling message from socket %s", e)
 
 
-    def handle_lobby_command(self, lobby_command, client_socket):
+    def open_metrics_socket(self, path):
         """
-        Parent command handler funtion.
+        Serve metrics in Prometheus text format on a local Unix socket,
+        e.g. curl --unix-socket PATH http://localhost/metrics
+        """
+        if os.path.exists(path):
+            os.unlink(path)
+        self.metrics_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.metrics_socket.bind(path)
+        self.metrics_socket.listen()
+        self.metrics_socket.setblocking(False)
+        self.sockets_list.append(self.metrics_socket)
+        log.info("Metrics endpoint listening on %s", path)
+
+    def accept_scrape(self):
+        try:
+            conn, _ = self.metrics_socket.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        self.scrapes.add(conn)
+        self.sockets_list.append(conn)
 
-        Perform a secondary filtering and validation check on client command.
-        Interpret the type of command and send it to the appropriate sub-handler.
-        """
-        lobby_command = lobby_command.decode('utf-8')
-        words = lobby_command.split()
-        first = words[0]
-
-        # Catch initial errors
-        if len(words) == 1:
-            msg = ''
-            if first == "$$create" or first == "$$delete":
-                msg = "Must specify a room name argument to execute $$create or $$delete! [E.g. $$create pokemon]"
-                print("User did not specify roomname to create or delete")
-            elif first == "$$send":
-                msg = "Must specify a room to send your message for $$send [E.g. $$send pokemon]!"
-                print("User did not specify a room to send a message to")
-            elif first == "$$join" or first == "$$leave":
-                msg = "Must specify a room name argument to execute $$join or $$leave! [E.g. $$join pokemon]"
-                print("User did not specify roomname to join or leave")
-            elif first == "$$enter":
-                msg = "Must specify a room name argument to execute $$enter! [E.g. $$enter pokemon]"
-                print("User did not specify roomname to enter")
-            elif msg != '':
-                print("Error catching failed ...")
-                return
+    def answer_scrape(self, conn):
+        """
+        Whatever the request, answer with the current metrics and hang up.
+        The exposition is far smaller than a Unix socket buffer, so one
+        non-blocking send is enough.
+        """
+        self.scrapes.discard(conn)
+        self.sockets_list.remove(conn)
+        try:
+            if conn.recv(RECV_CHUNK):
+                conn.send(self.metrics.http_response(self.write_stats, self.queue_depths()))
+        except OSError as e:
+            log.warning("Error answering metrics scrape %s", e)
+        conn.close()
+
+    def queue_depths(self):
+        return [self.backlog(client_socket) for client_socket in self.clients]
+
+    def handle_writes(self, write_sockets):
+        """
+        Drain the outbound queues of the given sockets, one gathered write each.
+        Sockets that couldn't take everything wait for select to report them writable.
+        Sockets whose backlog fell below the low watermark are read from again,
+        starting with any messages deferred while they were paused.
+
+        Writes can happen before the end of the iteration, for a socket
+        that became writable or a queue past FLUSH_THRESHOLD, so room
+        changes the output may acknowledge are committed first.
+        """
+        self.store.commit()
+        for notified_socket in write_sockets:
+            self.pending_writes.discard(notified_socket)
+            queue = self.outbound.get(notified_socket)
+            if queue is None:
+                continue
+            try:
+                queue.drain(notified_socket)
+            except OSError as e:
+                log.warning("Error writing to socket %s", e)
+                self.close_client(notified_socket)
+                continue
+            if len(queue):
+                self.blocked_writes.add(notified_socket)
+            else:
+                self.blocked_writes.discard(notified_socket)
+            if notified_socket in self.paused and len(queue) <= self.low_watermark:
+                self.paused.discard(notified_socket)
+                self.caught_up(notified_socket)
+                if notified_socket in self.throttled:
+                    continue
+                deferred = self.deferred.pop(notified_socket, None)
+                if deferred:
+                    self.handle_messages(notified_socket, deferred)
+
+
+    def handle_lobby_command(self, command, client_socket):
+        """
+        Parent command handler funtion.
 
-        if first == "$$create":
-            self.handle_create_room(lobby_command, client_socket)
-        elif first == "$$delete":
-            self.handle_delete_room(lobby_command, client_socket)
-        elif first == "$$join":
-            self.handle_join_room(lobby_command, client_socket)
-        elif first == "$$leave":
-            self.handle_leave_room(lobby_command, client_socket)
-        elif first == "$$list":
-            self.handle_list_room(lobby_command, client_socket)
-        elif first == "$$send":
-            self.handle_send_to_room(lobby_command, client_socket)
-        elif first == "$$enter":
-            self.handle_enter_room_session(lobby_command, client_socket)
-        elif first == "$$exit":
-            self.handle_exit_room_session(lobby_command, client_socket)
-        elif first == "$$whoami":
-            self.handle_whoami(client_socket)
+        The command was validated when it was parsed, look up its handler in
+        the command registry: a Server method for the built in commands, or a
+        function taking the server for plugin commands.
+        """
+        session = self.clients[client_socket]
+        command.user = session.name
+        command.uid = session.uid
+        handler = command.spec.handler
+        if isinstance(handler, str):
+            getattr(self, handler)(command, client_socket)
         else:
-            print("Not sure how this lobby command got to server. Should have been filtered by client filter")
+            handler(self, command, client_socket)
 
-    def handle_whoami(self, client_socket):
+    def handle_whoami(self, command, client_socket):
         """
         Easy messaging sanity check.
         """
-        user = self.clients[client_socket]['data'].decode('utf-8')
-        print(f'User {user} queried their identity')
+        user = command.user
+        log.debug('User %s queried their identity', user)
         msg = f'You are currently user {user}'
         self.log_and_send(client_socket, msg)
 
-    def handle_create_room(self, lobby_command, client_socket):
+    def handle_stats(self, command, client_socket):
+        """
+        Handles command of the form '$$stats'
+        Server admins (--admin) get a summary of the server metrics.
+        """
+        user = command.user
+        if user not in self.admins:
+            msg = f'User {user} is not a server admin.'
+            self.log_and_send(client_socket, msg)
+            return
+        self.just_send(client_socket, self.metrics.summary(self.write_stats, self.queue_depths()))
+
+    def handle_create_room(self, command, client_socket):
         """
         Handles command of the form '$$create [roomname]'
         Room must not already exist or use a reserved word: mine or all
@@ -316,202 +861,240 @@ class Server:
         TODO BUG: room is still created if non-alpha, but client is told
         that operation failed!!
         """
-        msg = "Handling room creation of {0}".format(lobby_command)
-        print(msg)
-        user = self.clients[client_socket]['data'].decode('utf-8')
-        roomname = lobby_command.split()[1]
+        log.debug("Handling room creation of %s", command.room)
+        user = command.user
+        roomname = command.room
 
         if roomname == "mine" or roomname == "all":
             msg = f'Client {user} error! reserved word that cannot be a room name.'
             self.log_and_send(client_socket, msg)
             return
 
-        for room in self.rooms:
-            if room.name == roomname:
-                msg = f"Invalid request from client: {roomname} already exists!"
-                self.log_and_send(client_socket, msg)
-                return
+        if roomname in self.registry.rooms:
+            msg = f"Invalid request from client: {roomname} already exists!"
+            self.log_and_send(client_socket, msg)
+            return
 
-        self.rooms.append(Room(name=roomname, creator=user))
+        self.registry.add_room(Room(name=roomname, creator=user))
         msg = f"Room {roomname} created for client {user} (creator/Admin)."
         self.log_and_send(client_socket, msg)
         return
     
 
-    def handle_delete_room(self, lobby_command, client_socket):
+    def handle_delete_room(self, command, client_socket):
         """
         Handles command of the form '$$delete [roomname]'
         Only admins can delete rooms. There is no second confirmation.
         Other users are silently dropped from the room.
         """
-        user = self.clients[client_socket]['data'].decode('utf-8')
-        roomname = lobby_command.split()[1]
-        msg = f"Handling room deletion of {roomname} by {user}"
-        print(msg)
-        for _room in self.rooms:
-            if _room.name == roomname and user in _room.room_attrbts['admins']:
-                msg = f"Room {roomname} is being deleted by admin {user}"
-                self.rooms.remove(_room)
-                self.log_and_send(client_socket, msg)
-                return
+        user = command.user
+        roomname = command.room
+        log.debug("Handling room deletion of %s by %s", roomname, user)
+        _room = self.registry.get(roomname)
+        if _room is not None and _room.is_admin(command.uid):
+            msg = f"Room {roomname} is being deleted by admin {user}"
+            self.registry.delete_room(roomname)
+            self.log_and_send(client_socket, msg)
+            return
         msg = f"Room {roomname} was not found or user is not permitted to delete"
         self.log_and_send(client_socket, msg)
 
 
 
-    def handle_join_room(self, lobby_command, client_socket):
+    def handle_join_room(self, command, client_socket):
         """
         Handles command of the form '$$join [roomname]'
         Client can only join a room if they have haven't already joined and passed a valid roomname.
         """
-        user = self.clients[client_socket]['data'].decode('utf-8')
-        words = lobby_command.split()
-        roomname = words[1]
-        print(f"Handling join room {roomname} for {user}")
-        for _room in self.rooms:
-            if _room.name == roomname:
-                print("Requested roomname found..")
-                if user in _room.room_attrbts['members']:
-                    msg = f"Client {user} is already a member of room {_room.name}"
-                    self.log_and_send(client_socket, msg)
-                    return
-                else:
-                    _room.room_attrbts['members'].add(user)
-                    msg = f"{user} successfully joined membership of room {roomname}"
-                    self.log_and_send(client_socket, msg)
-                    return
+        user = command.user
+        roomname = command.room
+        log.debug("Handling join room %s for %s", roomname, user)
+        _room = self.registry.get(roomname)
+        if _room is not None:
+            log.debug("Requested roomname found..")
+            if command.uid in _room.members:
+                msg = f"Client {user} is already a member of room {_room.name}"
+                self.log_and_send(client_socket, msg)
+                return
+            else:
+                self.registry.join(_room, command.uid)
+                msg = f"{user} successfully joined membership of room {roomname}"
+                self.log_and_send(client_socket, msg)
+                return
         msg = f'Client {user} passed invalid room. Could not join room {roomname}'
         self.log_and_send(client_socket, msg)
         return
 
 
-    def handle_leave_room(self, lobby_command, client_socket):
+    def handle_leave_room(self, command, client_socket):
         """
         Handles command of the form '$$leave [roomname]'
         Client can only leave a room if they have actually joined and passed a valid roomname.
         """
-        user = self.clients[client_socket]['data'].decode('utf-8')
-        words = lobby_command.split()
-        roomname = words[1]
-        print(f"Handling leave room {roomname} for {user}")
-        for _room in self.rooms:
-            if _room.name == roomname:
-                print("Requested roomname found..")
-                if user not in _room.room_attrbts['members']:
-                    msg = f"Client {user} is already NOT a member of room {_room.name}"
-                    self.log_and_send(client_socket, msg)
-                    return
-                else:
-                    _room.room_attrbts['members'].remove(user)
-                    msg = f"User {user} successfully removed from room {roomname}"
-                    self.log_and_send(client_socket, msg)
-                    return
+        user = command.user
+        roomname = command.room
+        log.debug("Handling leave room %s for %s", roomname, user)
+        _room = self.registry.get(roomname)
+        if _room is not None:
+            log.debug("Requested roomname found..")
+            if command.uid not in _room.members:
+                msg = f"Client {user} is already NOT a member of room {_room.name}"
+                self.log_and_send(client_socket, msg)
+                return
+            else:
+                self.registry.leave(_room, command.uid)
+                msg = f"User {user} successfully removed from room {roomname}"
+                self.log_and_send(client_socket, msg)
+                return
         msg = f'Client {user} passed invalid room. Could not join room {roomname}'
         self.log_and_send(client_socket, msg)
         return
 
 
-    def handle_list_room(self, lobby_command, client_socket):
+    def handle_list_room(self, command, client_socket):
         """
-        Handles command of the form '$$list (roomname|all|mine)'
+        Handles command of the form '$$list (roomname|all|mine) (cursor) (limit)'
         User is able to list all rooms, members of a specific room,
         all rooms and members, and their own membership in rooms.
 
-        Build a big string and send it on back!
+        Listings are paged: a page is limit entries (LIST_PAGE by default)
+        from position cursor on, and tells the client how to ask for the next
+        one. A bare number pages the list of rooms. Pages are streamed in
+        frames of bounded size, see directory.py.
         """
-        print("Handling list command...")
-        msg = ''
-        words = lobby_command.split()
+        log.debug("Handling list command...")
+        target = command.room
+        paging = command.args[1:]
+        if target is not None and target.isdigit() and target not in self.registry.rooms:
+            target, paging = None, command.args
+        try:
+            cursor, limit = self.page_args(paging)
+        except ValueError:
+            msg = f"format for command is $$list [roomname|mine|all] (cursor) (limit)"
+            self.log_and_send(client_socket, msg)
+            return
+        end = cursor + limit
+
         # List all rooms
-        if len(words) == 1:
-            msg = 'Available Rooms:\n'
-            for room in self.rooms:
-                msg += f'\t\t{room.name}\n'
-            
-            self.just_send(client_socket, msg)
+        if target is None:
+            names = self.directory.room_names()
+            lines = (f'\t\t{name}\n' for name in names[cursor:end])
+            self.send_listing(client_socket, 'Available Rooms:\n', lines, len(names), cursor, limit, '$$list')
             return
-        else:
-            # List all rooms and members
-            roomname = words[1]
-            if roomname == "all":
-                user = self.clients[client_socket]['data'].decode('utf-8')
-                msg = f'All rooms and users:\n'
-                for room in self.rooms:
-                    msg += f'Room: {room.name}\nUsers: '
-                    for user in room.room_attrbts['members']:
-                        msg += f'\t{user}'
-                        if user in room.room_attrbts['admins']:
-                            msg += ' - Admin'
-                        msg += '\n'
-                    msg += '\n'
-                self.just_send(client_socket, msg)
-                return
 
-            # List user's room membership
-            if roomname == "mine":
-                user = self.clients[client_socket]['data'].decode('utf-8')
-                msg = f'Rooms user {user} has joined:\n'
-                for room in self.rooms:
-                    if user in room.room_attrbts['members']:
-                        msg += f'\t\t{room.name}'
-                        if user in room.room_attrbts['admins']:
-                            msg += ' - Admin'
-                        msg += '\n'
-                self.just_send(client_socket, msg)
-                return
-            
-            # List membership and active users of a room
-            for _room in self.rooms:
-                if _room.name == roomname:
-                    print("Request roomname found..")
-                    msg = f'User members of room {roomname}:\n'
-                    for member in _room.room_attrbts['members']:
-                        msg += f'\t\t{member}\n'
-                    msg+= '\n'
-                    self.just_send(client_socket, msg)
-                    
-                    msg = 'Users active in room:\n'
-                    for active_user in _room.room_attrbts['active']:
-                        msg += f'\t\t{active_user}\n'
-                    self.just_send(client_socket, msg)
-                    return
-            if msg == '':
-                msg = f'Client passed an invalid room to list members of {roomname}\n'
-                self.log_and_send(client_socket, msg)
-                return
-    
-    def handle_send_to_room(self, lobby_command, client_socket):
+        # List all rooms and members
+        if target == "all":
+            names = self.directory.room_names()
+            entries = self.directory.entries_from(names[cursor:end])
+            self.send_listing(client_socket, 'All rooms and users:\n', entries, len(names), cursor, limit, '$$list all')
+            return
+
+        # List user's room membership
+        if target == "mine":
+            rooms = self.registry.rooms_of(command.uid)
+            lines = (f"\t\t{room.name}{' - Admin' if room.is_admin(command.uid) else ''}\n" for room in rooms[cursor:end])
+            self.send_listing(client_socket, f'Rooms user {command.user} has joined:\n', lines, len(rooms), cursor, limit,
+                              '$$list mine')
+            return
+
+        # List membership and active users of a room
+        _room = self.registry.get(target)
+        if _room is not None:
+            log.debug("Request roomname found..")
+            lines = (f'\t\t{USERS.name(uid)}\n' for uid in itertools.islice(_room.members, cursor, end))
+            self.send_listing(client_socket, f'User members of room {target}:\n', itertools.chain(lines, ('\n',)),
+                              len(_room.members), cursor, limit, f'$$list {target}')
+            lines = (f'\t\t{USERS.name(uid)}\n' for uid in _room.active)
+            for frame in frames(itertools.chain(('Users active in room:\n',), lines)):
+                self.just_send(client_socket, frame)
+            return
+        msg = f'Client passed an invalid room to list members of {target}\n'
+        self.log_and_send(client_socket, msg)
+
+    @staticmethod
+    def page_args(args):
+        """
+        (cursor, limit) from the optional paging arguments of $$list.
+        Raises ValueError unless they are numbers, the limit above 0.
+        """
+        if not all(arg.isdigit() for arg in args):
+            raise ValueError(args)
+        cursor = int(args[0]) if args else 0
+        limit = int(args[1]) if len(args) > 1 else LIST_PAGE
+        if limit <= 0:
+            raise ValueError(args)
+        return cursor, min(limit, LIST_MAX)
+
+    def send_listing(self, client_socket, header, parts, total, cursor, limit, again):
+        """
+        Stream one page of a listing, given as lazily generated text parts.
+        total is the length of the whole listing and again the command
+        listing it, for the hint about the next page.
+        """
+        end = cursor + limit
+        footer = (f'{total - end} more, next page: {again} {end} {limit}\n',) if end < total else ()
+        for frame in frames(itertools.chain((header,), parts, footer)):
+            self.just_send(client_socket, frame)
+
+    def handle_send_to_room(self, command, client_socket):
         """
         Handles command of the form '$$send [roomname] "msg"
 
         Fundamental algorithm for distributing messages to other clients.
-        Look for the matching room, then send the message to any users who
-        are members of that room.
-
-        Not ideal performance to be sure.
-        """
-        words = lobby_command.split()
-        sent_name = words[1]
-        sending_user = self.clients[client_socket]['data'].decode('utf-8')
-        for room in self.rooms:
-            if room.name == sent_name:
-                actual_words = words[2:]
-                actual_words = ' '.join(actual_words)
-                actual_words += '\n'
-                msg = f"[{sent_name}] {sending_user}: {actual_words}"
-                for client in self.clients:
-                    found_user = self.clients[client]['data'].decode('utf-8')
-                    if found_user in room.room_attrbts['members'] and found_user != sending_user:
-                        self.log_and_send(client, msg)
-                print(f"Successfully sent message to all members of {sent_name}")
-                return
+        Look up the room, then broadcast the message to its online members,
+        which the registry keeps so offline members cost nothing here.
+
+        The message is relayed as the bytes the sender sent, a view of its
+        frame, when the command was parsed with parse_send or from v2 fields.
+        """
+        sent_name = command.room
+        sending_user = command.user
+        room = self.registry.get(sent_name)
+        if room is not None:
+            actual_words = command.body if command.body is not None else command.arg(1, '')
+            users = self.registry.users
+            sender = command.uid
+            recipients = [users[member] for member in room.online if member != sender]
+            count = self.broadcast(recipients, sent_name, sending_user, actual_words)
+            self.metrics.fanout.observe(count)
+            self.history.append(sent_name, sending_user, actual_words)
+            log.debug("Successfully sent message of %d characters to %d members of %s", len(actual_words), count, sent_name)
+            return
         msg = f"Could not find room {sent_name} requested by {sending_user}"
         self.log_and_send(client_socket, msg)
         msg = f"format for command is $$send [roomname] message"
         self.log_and_send(client_socket, msg)
         return
 
-    def handle_enter_room_session(self, lobby_command, client_socket):
+    def handle_history(self, command, client_socket):
+        """
+        Handles command of the form '$$history [roomname] (n)'
+
+        Members of a room can replay the last n messages sent to it, oldest first.
+        They are delivered like any other room message.
+        """
+        sent_name = command.room
+        user = command.user
+        room = self.registry.get(sent_name)
+        if room is None or command.uid not in room.members:
+            msg = f'Room {sent_name} not found or user {user} is not yet a member.'
+            self.log_and_send(client_socket, msg)
+            return
+        count = HISTORY_DEFAULT
+        if command.arg(1) is not None:
+            if not command.arg(1).isdigit():
+                msg = f"format for command is $$history [roomname] [number of messages]"
+                self.log_and_send(client_socket, msg)
+                return
+            count = min(int(command.arg(1)), HISTORY_MAX)
+        messages = self.history.last(sent_name, count)
+        log.debug("Replaying %d messages of %s to %s", len(messages), sent_name, user)
+        self.just_send(client_socket, f"Last {len(messages)} messages of room {sent_name}:")
+        for sending_user, body in messages:
+            self.broadcast([client_socket], sent_name, sending_user, body)
+        return
+
+    def handle_enter_room_session(self, command, client_socket):
         """
         Handles command of the form '$$enter [roomname]'
 
@@ -519,20 +1102,18 @@ class Server:
         The ACTIVE and NONACTIVE strings are interpreted on the client sides as messages indicating
         their change in 'entered' state.
         """
-        words = lobby_command.split()
-        sent_name = words[1]
-        user = self.clients[client_socket]['data'].decode('utf-8')
-        for room in self.rooms:
-            if room.name == sent_name and user in room.room_attrbts['members']:
-                room.room_attrbts['active'].add(user)
-                msg = f'User {user} is a member of room {sent_name}. Entering user into active mode for this room. ACTIVE'
-                print(msg)
-                return
+        sent_name = command.room
+        user = command.user
+        room = self.registry.get(sent_name)
+        if room is not None and command.uid in room.members:
+            self.registry.enter(room, command.uid)
+            log.debug('User %s is a member of room %s. Entering user into active mode for this room. ACTIVE', user, sent_name)
+            return
         msg = f'Room {sent_name} not found or user {user} is not yet a member. NONACTIVE'
         self.log_and_send(client_socket, msg)
         return
 
-    def handle_exit_room_session(self, lobby_command, client_socket):
+    def handle_exit_room_session(self, command, client_socket):
         """
         Handles command of the form '$$exit'
 
@@ -540,29 +1121,216 @@ class Server:
         The NONACTIVE string is interpreted on the client sides as indicating
         their change in 'entered' state.
         """
-        user = self.clients[client_socket]['data'].decode('utf-8')
-        for room in self.rooms:
-            if user in room.room_attrbts['active']:
-                room.room_attrbts['active'].remove(user)
-                msg = f'User {user} is no longer active in room {room.name}.'
-                print(msg)
-                return
-        msg = f'Room {room.name} not found or user {user} is not yet a member. NONACTIVE'
+        user = command.user
+        room = self.registry.active_room(command.uid)
+        if room is not None:
+            self.registry.exit(room, command.uid)
+            log.debug('User %s is no longer active in room %s.', user, room.name)
+            return
+        msg = f'User {user} is not active in any room. NONACTIVE'
         self.log_and_send(client_socket, msg)
         return
 
+    def apply_event(self, op, roomname, user):
+        """
+        Apply a change made elsewhere, by a room's owner or a linked server, to the local replica.
+        Changes that are already reflected locally are skipped.
+        """
+        room = self.registry.get(roomname)
+        if op == 'create':
+            if room is None:
+                self.registry.add_room(Room(name=roomname, creator=user))
+            return
+        if room is None:
+            return
+        if op == 'delete':
+            self.registry.delete_room(roomname)
+            return
+        if op in ('join', 'enter'):
+            uid = USERS.id(user)
+        else:
+            # A name nobody refers to can't be leaving or exiting
+            uid = USERS.find(user)
+            if uid is None:
+                return
+        if op == 'join' and uid not in room.members:
+            self.registry.join(room, uid)
+        elif op == 'leave' and uid in room.members:
+            self.registry.leave(room, uid)
+        elif op == 'enter' and uid not in room.active:
+            self.registry.enter(room, uid)
+        elif op == 'exit' and uid in room.active:
+            self.registry.exit(room, uid)
+
+    def handle_watch(self, command, client_socket):
+        """
+        Handles command of the form '$$watch [roomname]'
+
+        From now on the client is told who joins, leaves, enters and exits
+        the room, one update per loop iteration, see presence.py.
+        Anyone may watch a room, the same as anyone may $$list its members.
+        """
+        roomname = command.room
+        room = self.registry.get(roomname)
+        if room is None:
+            msg = f'Client {command.user} passed invalid room. Could not watch room {roomname}'
+            self.log_and_send(client_socket, msg)
+            return
+        self.presence.watch(client_socket, roomname)
+        msg = f"Watching room {roomname}: {len(room.members)} members, {len(room.active)} active"
+        self.log_and_send(client_socket, msg)
+
+    def handle_unwatch(self, command, client_socket):
+        """
+        Handles command of the form '$$unwatch [roomname]'
+        """
+        roomname = command.room
+        if self.presence.unwatch(client_socket, roomname):
+            msg = f"Stopped watching room {roomname}"
+        else:
+            msg = f"Client {command.user} is not watching room {roomname}"
+        self.log_and_send(client_socket, msg)
+
+    def publish_presence(self):
+        """
+        Send the presence changes of this iteration, one update per watched room.
+        """
+        for roomname, changes, watchers in self.presence.take():
+            self.fan_out(watchers, lambda codec: codec.presence(roomname, changes))
+
     def run(self):
         """
         Forever:
-                Listen for connections with select, handle connections and handle errors
+                Listen for connections with select, handle connections,
+                write queued output and handle errors
         """
-        print("Central server now listening...")
+        log.info("Central server now listening...")
+        throttle_due = None
+        handshake_due = None
         while True:
-            read_sockets, _, exception_sockets = select.select(self.sockets_list, [], self.sockets_list)
+            read_list = self.read_list()
+            timeout = 0 if self.pending_writes else min((due for due in (throttle_due, handshake_due) if due is not None),
+                                                        default=None)
+            if self.consumers.lagging:
+                timeout = min(timeout, CONSUMER_CHECK) if timeout is not None else CONSUMER_CHECK
+            read_sockets, write_sockets, exception_sockets = select.select(read_list, list(self.blocked_writes), self.sockets_list, timeout)
+            started = time.perf_counter()
             self.handle_conns(read_sockets)
+            self.handle_writes(write_sockets)
             self.handle_exceptions(exception_sockets)
+            self.release_throttled()
+            handshake_due = self.expire_handshakes()
+            self.end_tick()
+            throttle_due = self.throttle_due()
+            self.metrics.loop.observe(time.perf_counter() - started)
+
+
+    def schedule_tick(self):
+        """
+        Make sure the current iteration ends with end_tick. The select loop
+        always does.
+        """
 
+    def end_tick(self):
+        """
+        End of an event loop iteration: make the room changes made during it
+        durable, then send the replies and presence updates.
+        """
+        if self.consumers.lagging:
+            self.check_consumers()
+        self.store.commit()
+        if self.persist and self.store.due():
+            self.store.snapshot(self.registry.room_list())
+        if self.presence.pending:
+            self.publish_presence()
+        self.flush_output()
 
-s = Server()
-signal.signal(signal.SIGINT, s.signal_handler)
-s.run()
+
+    def flush_output(self):
+        """
+        Flush everything queued during this iteration, one write per socket.
+        """
+        if self.pending_writes:
+            self.handle_writes(list(self.pending_writes))
+
+
+def parse_args():
+    """
+    Server options. The default select engine is fine for small servers,
+    the asyncio engine uses the platform's best selector (epoll on Linux)
+    and is not capped by FD_SETSIZE.
+    """
+    parser = argparse.ArgumentParser(description="TinyIRC chat server")
+    parser.add_argument('--engine', choices=['select', 'asyncio'], default='select',
+                        help="event loop used to serve client connections")
+    parser.add_argument('--port', type=int, default=LISTENING_PORT,
+                        help="port clients connect to")
+    parser.add_argument('--high-watermark', type=int, default=HIGH_WATERMARK,
+                        help="unsent bytes at which reads from a client are paused")
+    parser.add_argument('--low-watermark', type=int, default=LOW_WATERMARK,
+                        help="unsent bytes at which reads from a paused client resume")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes sharing the port (select engine only)")
+    parser.add_argument('--admin', action='append', default=[],
+                        help="user allowed to run admin commands like $$stats, may be repeated")
+    parser.add_argument('--metrics-socket',
+                        help="serve Prometheus metrics on this Unix socket path")
+    parser.add_argument('--log-level', choices=LEVELS, default='info',
+                        help="least severe level written to the server log")
+    parser.add_argument('--rate-limit', action='append', default=[], metavar='CLASS=RATE[/BURST]',
+                        help="commands per second and burst allowed per connection, for a rate class "
+                             "(total, send, query or control), may be repeated. A rate of 0 disables the limit. "
+                             "Defaults: " + ", ".join(f"{name}={rate:g}/{burst:g}" for name, (rate, burst) in RATE_LIMITS.items()))
+    parser.add_argument('--plugin', action='append', default=[],
+                        help="module to import that registers extra commands, may be repeated")
+    parser.add_argument('--server-name',
+                        help="name of this server on a federated network, defaults to IP:PORT")
+    parser.add_argument('--link-port', type=int,
+                        help="port other servers link to this one on, see federation.py")
+    parser.add_argument('--link', action='append', default=[], metavar='HOST:PORT',
+                        help="link port of a server to join the network of, may be repeated")
+    args = parser.parse_args()
+    if args.workers > 1 and args.engine != 'select':
+        parser.error("--workers requires the select engine")
+    args.federated = args.link_port is not None or bool(args.link)
+    if args.federated and (args.workers > 1 or args.engine != 'select'):
+        parser.error("--link and --link-port require the select engine and a single worker")
+    if args.server_name is None:
+        args.server_name = f"{IP}:{args.port}"
+    try:
+        from federation import parse_link
+        args.links = [parse_link(text) for text in args.link]
+    except ValueError as e:
+        parser.error(str(e))
+    args.rate_limits = dict(RATE_LIMITS)
+    try:
+        args.rate_limits.update(parse_rate_limit(text) for text in args.rate_limit)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    setup_logging(args.log_level)
+    for plugin in args.plugin:
+        importlib.import_module(plugin)
+        log.info("Loaded plugin %s", plugin)
+    if args.workers > 1:
+        from cluster import run_cluster
+        run_cluster(args.workers, args.high_watermark, args.low_watermark, args.admin, args.rate_limits, args.port,
+                    log_level=args.log_level, metrics_socket=args.metrics_socket)
+        sys.exit(0)
+    if args.federated:
+        from federation import LinkedServer
+        s = LinkedServer(args.server_name, args.link_port, args.links,
+                         args.high_watermark, args.low_watermark, args.admin, args.rate_limits, args.port)
+    elif args.engine == 'asyncio':
+        from aioserver import AsyncServer
+        s = AsyncServer(args.high_watermark, args.low_watermark, args.admin, args.rate_limits, args.port)
+    else:
+        s = Server(args.high_watermark, args.low_watermark, args.admin, args.rate_limits, args.port)
+    if args.metrics_socket:
+        s.open_metrics_socket(args.metrics_socket)
+    signal.signal(signal.SIGINT, s.signal_handler)
+    s.run()
@@ -0,0 +1,33 @@
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from persistence import RoomStore
+
+
+def room(name):
+    return SimpleNamespace(name=name, topic='')
+
+
+def test_torn_log_tail_is_cut_before_appending(tmp_path):
+    path = str(tmp_path / 'store.d')
+    store = RoomStore(path, sync=False)
+    store.load()
+    store.record('create', room('before'), 'alice')
+    store.commit()
+    store.log.close()
+
+    # Crash mid write
+    with open(store.log_path, 'a') as f:
+        f.write('{"op":"join","ro')
+
+    store = RoomStore(path, sync=False)
+    assert [record['name'] for record in store.load()] == ['before']
+    store.record('create', room('after'), 'bob')
+    store.commit()
+    store.log.close()
+
+    store = RoomStore(path, sync=False)
+    assert [record['name'] for record in store.load()] == ['before', 'after']
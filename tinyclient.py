@@ -0,0 +1,235 @@
+import asyncio
+import collections
+
+from commands import COMMAND_OPCODES, parse_command
+from framing import (HEADER_LENGTH, RECV_CHUNK, OP_REPLY, OP_MESSAGE, OP_DONE, OP_PRESENCE,
+                     FramingError, V2FrameDecoder, encode_frame, encode_v2, parse_header)
+
+# Asynchronous TinyIRC client library.
+#
+#     async with TinyClient('alice') as client:
+#         await client.join('pokemon')
+#         client.send('pokemon', 'hello')
+#         async for message in client:
+#             print(message.room, message.user, message.body)
+#
+# The client speaks protocol v2, where the server ends the replies to every
+# command with a DONE frame. Command methods send right away and return a
+# future of that command's replies, so callers can await each one or fire
+# off many and only await the ones they care about.
+
+IP = "127.0.0.1"
+CONNECTION_PORT = 9001
+
+# Room messages buffered before the client stops reading from the server
+INBOX_SIZE = 10000
+
+
+Message = collections.namedtuple('Message', 'room user body')
+Message.__doc__ = """
+A message relayed from a room. Server notices that don't answer any
+command, like being booted, come through with room and user set to None.
+"""
+
+Presence = collections.namedtuple('Presence', 'room changes')
+Presence.__doc__ = """
+Who joined, left, entered or exited a watched room since the last update.
+changes is a tuple of (op, users) pairs, op being 'join', 'leave', 'enter',
+'exit', or 'delete' if the room is gone.
+"""
+
+
+class TinyClient:
+    """
+    One connection to a TinyIRC server.
+    """
+    def __init__(self, username, host=IP, port=CONNECTION_PORT, compress=True):
+        self.username = username
+        self.host = host
+        self.port = port
+        self.compress = compress
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.waiting = collections.deque()
+        self.inbox = asyncio.Queue(INBOX_SIZE)
+        self.closed = False
+        self.error = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __aiter__(self):
+        return self.messages()
+
+    async def connect(self):
+        """
+        Open the connection and negotiate protocol v2 in the username frame.
+        """
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        caps = 'v2 zlib' if self.compress else 'v2'
+        self.writer.write(encode_frame(f"{self.username} {caps}".encode('utf-8')))
+        header = await self.reader.readexactly(HEADER_LENGTH)
+        ack = (await self.reader.readexactly(parse_header(header))).decode('utf-8').split()
+        if ack[:1] != ['$$caps'] or 'v2' not in ack:
+            self.writer.close()
+            raise ConnectionError(f"Server did not accept protocol v2: {' '.join(ack)}")
+        self.reader_task = asyncio.create_task(self.read_loop())
+
+    async def close(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+        if self.reader_task is not None:
+            await self.reader_task
+
+    async def drain(self):
+        """
+        Wait until the socket has taken what was sent so far. Worth calling
+        now and then when sending a lot without awaiting the replies.
+        """
+        await self.writer.drain()
+
+    # Incoming
+    async def read_loop(self):
+        decoder = V2FrameDecoder(inflate=True)
+        try:
+            while True:
+                data = await self.reader.read(RECV_CHUNK)
+                if not data:
+                    break
+                for message in decoder.feed(data):
+                    await self.dispatch(message)
+        except (OSError, FramingError) as e:
+            self.error = e
+        finally:
+            self.closed = True
+            while self.waiting:
+                future, _ = self.waiting.popleft()
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection to server lost"))
+            try:
+                self.inbox.put_nowait(None)
+            except asyncio.QueueFull:
+                # messages() notices the close once it has drained the inbox
+                pass
+
+    async def dispatch(self, message):
+        opcode = message['opcode']
+        fields = [field.decode('utf-8') for field in message['fields']]
+        if opcode == OP_MESSAGE:
+            await self.inbox.put(Message(*fields))
+        elif opcode == OP_PRESENCE:
+            pairs = zip(fields[1::2], fields[2::2])
+            await self.inbox.put(Presence(fields[0], tuple((op, tuple(users.split())) for op, users in pairs)))
+        elif opcode == OP_REPLY:
+            if self.waiting:
+                self.waiting[0][1].append(fields[0])
+            else:
+                await self.inbox.put(Message(None, None, fields[0]))
+        elif opcode == OP_DONE and self.waiting:
+            future, replies = self.waiting.popleft()
+            if not future.done():
+                future.set_result(replies)
+
+    async def messages(self):
+        """
+        Room messages and presence updates as they arrive, until the
+        connection closes.
+        """
+        while not (self.closed and self.inbox.empty()):
+            message = await self.inbox.get()
+            if message is None:
+                return
+            yield message
+
+    def pending_messages(self):
+        """
+        Room messages received so far, without waiting for more.
+        """
+        messages = []
+        while not self.inbox.empty():
+            message = self.inbox.get_nowait()
+            if message is None:
+                break
+            messages.append(message)
+        return messages
+
+    # Commands
+    def command(self, command, *fields):
+        """
+        Send a $$ command with its arguments. Returns a future of the list
+        of reply lines, which is empty for commands that succeed silently.
+        """
+        if self.closed:
+            raise ConnectionError("Connection to server lost")
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append((future, []))
+        self.writer.write(encode_v2(COMMAND_OPCODES[command], *fields))
+        return future
+
+    def command_line(self, line):
+        """
+        Send a command as typed, e.g. '$$join pokemon' or '$$send pokemon hi all'.
+        Raises CommandError, a ValueError, for lines that don't parse.
+        """
+        command = parse_command(line)
+        return self.command(command.name, *command.args)
+
+    def whoami(self):
+        return self.command("$$whoami")
+
+    def create(self, room):
+        return self.command("$$create", room)
+
+    def delete(self, room):
+        return self.command("$$delete", room)
+
+    def join(self, room):
+        return self.command("$$join", room)
+
+    def leave(self, room):
+        return self.command("$$leave", room)
+
+    def list(self, what=None, cursor=None, limit=None):
+        """
+        Rooms, or with what the members of a room, 'mine' or 'all'.
+        Long listings are paged, cursor is the position to start from.
+        """
+        paging = [str(cursor or 0), str(limit)] if limit else [str(cursor)] if cursor else []
+        return self.command("$$list", *([what] if what else []), *paging)
+
+    def enter(self, room):
+        return self.command("$$enter", room)
+
+    def exit(self):
+        return self.command("$$exit")
+
+    def send(self, room, body):
+        return self.command("$$send", room, body)
+
+    def history(self, room, count=None):
+        """
+        The replayed messages arrive as room messages, the reply is a header line.
+        """
+        return self.command("$$history", room, *([str(count)] if count else []))
+
+    def stats(self):
+        return self.command("$$stats")
+
+    def watch(self, room):
+        """
+        Presence updates for the room arrive among the room messages.
+        """
+        return self.command("$$watch", room)
+
+    def unwatch(self, room):
+        return self.command("$$unwatch", room)